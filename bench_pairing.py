@@ -0,0 +1,160 @@
+"""
+マッチングのベンチマーク（ランダムに組む従来方式と MATCH_MODE=batch の比較）
+
+    python bench_pairing.py --rates 0.02 0.05 0.2 1 --minutes 120
+
+- 指定した到着率（人/秒）でマッチ希望が来る待機プールを、tick 秒ごとにマッチングする
+- WAITING_SECONDS 待っても組めなかった人はタイムアウトとして数える
+- マッチ率・平均待ち時間・ランク差・1回のマッチング処理時間を方式ごとに表示する
+- --check で、少人数のプールに対して並べ替え DP の結果が厳密解からどれだけ離れるかも確認する
+"""
+import os
+import sys
+import argparse
+import random
+import time
+
+# main.py は import 時に環境変数を読むのでダミーを入れておく
+for key, value in {
+    "ADMIN_ID": "1",
+    "GUILD_ID": "10",
+    "BATTLELOG_CHANNEL_ID": "20",
+    "ACTIVE_LOG_CHANNEL_ID": "21",
+    "MATCHING_CHANNEL_ID": "22",
+    "JUDGE_CHANNEL_ID": "23",
+    "RANKING_CHANNEL_ID": "24",
+    "DISCORD_TOKEN": "bench",
+}.items():
+    os.environ.setdefault(key, value)
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main  # noqa: E402
+
+
+def random_pt(rng, spread: bool):
+    """既定は低ランクに多く上位ほど少ない分布、spread なら全ランクに一様"""
+    if spread:
+        return rng.randrange(0, 30)
+    return min(int(rng.expovariate(1 / 8)), 40)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def simulate(mode: str, rate: float, seconds: float, tick: float, seed: int, spread: bool):
+    # 到着は専用の乱数列にして、どちらの方式でも同じ人が同じ時刻に来るようにする
+    rng = random.Random(seed)
+    random.seed(seed)
+    queue = main.MatchQueue()
+    joined = {}   # user_id -> 参加時刻
+    ranks = {}
+    waits = []
+    gaps = []
+    pass_times = []
+    timeouts = 0
+    arrivals = 0
+    next_uid = 1
+    now = 0.0
+    next_arrival = rng.expovariate(rate)
+    while now < seconds:
+        now += tick
+        while next_arrival <= now:
+            uid = next_uid
+            next_uid += 1
+            pt = random_pt(rng, spread)
+            queue.add(uid, pt)
+            joined[uid] = next_arrival
+            ranks[uid] = main.get_internal_rank(pt)
+            arrivals += 1
+            next_arrival += rng.expovariate(rate)
+        for uid in [u for u, t in joined.items() if now - t >= main.WAITING_SECONDS]:
+            queue.remove(uid)
+            del joined[uid]
+            timeouts += 1
+        started = time.perf_counter()
+        if mode == "batch":
+            pairs = queue.take_pairs_batch({uid: now - t for uid, t in joined.items()})
+        else:
+            pairs = queue.take_pairs()
+        pass_times.append(time.perf_counter() - started)
+        for u1, u2 in pairs:
+            waits.append(now - joined.pop(u1))
+            waits.append(now - joined.pop(u2))
+            gaps.append(abs(ranks[u1] - ranks[u2]))
+    matched = len(waits)
+    finished = matched + timeouts
+    return {
+        "arrivals": arrivals,
+        "match_rate": matched / finished if finished else 0.0,
+        "timeouts": timeouts,
+        "wait_avg": sum(waits) / matched if matched else 0.0,
+        "wait_p95": percentile(waits, 0.95),
+        "gap_avg": sum(gaps) / len(gaps) if gaps else 0.0,
+        "pass_avg_ms": sum(pass_times) / len(pass_times) * 1000 if pass_times else 0.0,
+        "pass_max_ms": max(pass_times, default=0.0) * 1000,
+    }
+
+
+def pairing_cost(players, pairs, share=None):
+    """batch_pairs と同じ式でコストを計算する"""
+    by_uid = {uid: (rank, w) for uid, rank, w in players}
+    paired = set()
+    cost = 0.0
+    for u1, u2 in pairs:
+        cost += abs(by_uid[u1][0] - by_uid[u2][0]) * main.PAIR_GAP_COST
+        paired.update((u1, u2))
+    for uid, (rank, w) in by_uid.items():
+        if uid not in paired:
+            cost += main.pair_skip_cost(rank, w, share)
+    return cost
+
+
+def check_optimality(trials: int, seed: int, spread: bool):
+    rng = random.Random(seed)
+    exact_max = main.PAIR_EXACT_MAX
+    worst = 0.0
+    suboptimal = 0
+    for _ in range(trials):
+        n = rng.randint(2, exact_max)
+        players = [(i, main.get_internal_rank(random_pt(rng, spread)), rng.uniform(0, main.WAITING_SECONDS)) for i in range(n)]
+        share = {rank: rng.random() for rank in main.rank_ranges_internal}
+        exact = pairing_cost(players, main.batch_pairs(players, main.MatchQueue.MAX_RANK_GAP, share), share)
+        main.PAIR_EXACT_MAX = 0
+        try:
+            approx = pairing_cost(players, main.batch_pairs(players, main.MatchQueue.MAX_RANK_GAP, share), share)
+        finally:
+            main.PAIR_EXACT_MAX = exact_max
+        if approx > exact + 1e-9:
+            suboptimal += 1
+            worst = max(worst, approx - exact)
+    print(f"並べ替え DP と厳密解の比較: {trials} 回中 {suboptimal} 回が厳密解より高コスト（最大差 {worst:.2f}）")
+
+
+def main_entry():
+    parser = argparse.ArgumentParser(description="マッチング方式のベンチマーク")
+    parser.add_argument("--rates", type=float, nargs="+", default=[0.02, 0.05, 0.2, 1.0, 5.0], help="到着率（人/秒）")
+    parser.add_argument("--minutes", type=float, default=120.0, help="シミュレーションする時間（分）")
+    parser.add_argument("--tick", type=float, default=main.MATCH_DEBOUNCE_SECONDS, help="マッチング処理の間隔（秒）")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--spread", action="store_true", help="pt を全ランクに一様に散らす")
+    parser.add_argument("--check", type=int, default=500, help="厳密解との比較回数（0 で省略）")
+    args = parser.parse_args()
+
+    print(f"{'rate':>6} {'mode':>6} {'arrivals':>8} {'match%':>7} {'timeout':>7} "
+          f"{'wait avg':>8} {'wait p95':>8} {'gap':>5} {'pass avg':>9} {'pass max':>9}")
+    for rate in args.rates:
+        for mode in ("random", "batch"):
+            r = simulate(mode, rate, args.minutes * 60, args.tick, args.seed, args.spread)
+            print(f"{rate:>6g} {mode:>6} {r['arrivals']:>8} {r['match_rate'] * 100:>6.1f}% {r['timeouts']:>7} "
+                  f"{r['wait_avg']:>7.1f}s {r['wait_p95']:>7.1f}s {r['gap_avg']:>5.2f} "
+                  f"{r['pass_avg_ms']:>7.2f}ms {r['pass_max_ms']:>7.2f}ms")
+    if args.check:
+        check_optimality(args.check, args.seed, args.spread)
+
+
+if __name__ == "__main__":
+    main_entry()
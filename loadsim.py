@@ -0,0 +1,374 @@
+"""
+負荷シミュレーション（Discord に接続せずに main.py のマッチング〜結果反映を回す）
+
+    python loadsim.py --players 500 --rounds 3
+
+- Guild / Member / Channel / Interaction の代わりに Fake* を使い、REST 呼び出しはすべて記録する
+- REST 呼び出しごとに遅延を入れ、一定確率で 429 を返す（discord.py と同じく待ってから再試行）
+- マッチ成立までの待ち時間、1試合あたりの REST 呼び出し数、イベントループの遅延を表示する
+"""
+import os
+import sys
+import asyncio
+import argparse
+import random
+import time
+from collections import Counter
+
+# main.py は import 時に環境変数を読むのでダミーを入れておく
+for key, value in {
+    "ADMIN_ID": "1",
+    "GUILD_ID": "10",
+    "BATTLELOG_CHANNEL_ID": "20",
+    "ACTIVE_LOG_CHANNEL_ID": "21",
+    "MATCHING_CHANNEL_ID": "22",
+    "JUDGE_CHANNEL_ID": "23",
+    "RANKING_CHANNEL_ID": "24",
+    "DISCORD_TOKEN": "loadsim",
+}.items():
+    os.environ.setdefault(key, value)
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import discord  # noqa: E402
+import main  # noqa: E402
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+# ----------------------------------------
+# REST 呼び出しの記録・遅延・429
+# ----------------------------------------
+class FakeHTTP:
+    def __init__(self, latency: float, jitter: float, rate_limit_prob: float, retry_after: float):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_prob = rate_limit_prob
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.rate_limited = Counter()
+
+    async def request(self, route: str):
+        self.calls[route] += 1
+        await asyncio.sleep(self.latency + random.random() * self.jitter)
+        # discord.py は 429 を受けると Retry-After だけ待って再送するので同じように振る舞う
+        while random.random() < self.rate_limit_prob:
+            self.rate_limited[route] += 1
+            await asyncio.sleep(self.retry_after)
+            await asyncio.sleep(self.latency)
+
+
+# ----------------------------------------
+# discord.py オブジェクトの代役
+# ----------------------------------------
+class FakeRole:
+    def __init__(self, role_id: int, name: str):
+        self.id = role_id
+        self.name = name
+
+    def is_default(self):
+        return self.name == "@everyone"
+
+
+class FakeMember:
+    def __init__(self, guild, member_id: int, name: str, bot: bool = False):
+        self.guild = guild
+        self.id = member_id
+        self.name = name
+        self.nick = None
+        self.bot = bot
+        self.roles = [guild.default_role]
+
+    @property
+    def display_name(self):
+        return self.nick or self.name
+
+    @property
+    def mention(self):
+        return f"<@{self.id}>"
+
+    async def edit(self, nick=discord.utils.MISSING, roles=discord.utils.MISSING):
+        await self.guild.http.request("PATCH /guilds/{guild_id}/members/{user_id}")
+        if nick is not discord.utils.MISSING:
+            self.nick = nick
+        if roles is not discord.utils.MISSING:
+            self.roles = [self.guild.default_role] + list(roles)
+
+
+class FakeMessage:
+    def __init__(self, channel, content: str, view=None):
+        self.channel = channel
+        self.content = content
+        self.view = view
+
+    async def edit(self, content=None, view=None):
+        await self.channel.guild.http.request("PATCH /channels/{channel_id}/messages/{message_id}")
+        self.content = content
+
+
+class FakeTextChannel:
+    def __init__(self, guild, channel_id: int, name: str, category_id=None):
+        self.guild = guild
+        self.id = channel_id
+        self.name = name
+        self.category_id = category_id
+        self.overwrites = {}
+        self.messages = []
+
+    async def send(self, content=None, view=None):
+        await self.guild.http.request("POST /channels/{channel_id}/messages")
+        msg = FakeMessage(self, content, view)
+        self.messages.append(msg)
+        self.guild.on_message(self, msg)
+        return msg
+
+    async def edit(self, name=None, overwrites=None):
+        await self.guild.http.request("PATCH /channels/{channel_id}")
+        if name:
+            self.name = name
+        if overwrites is not None:
+            self.overwrites = overwrites
+
+    async def purge(self, limit=None):
+        await self.guild.http.request("POST /channels/{channel_id}/messages/bulk-delete")
+        self.messages.clear()
+
+    async def delete(self):
+        await self.guild.http.request("DELETE /channels/{channel_id}")
+        self.guild.channels.pop(self.id, None)
+
+
+class FakeCategory:
+    def __init__(self, guild, channel_id: int):
+        self.guild = guild
+        self.id = channel_id
+
+    @property
+    def text_channels(self):
+        return [ch for ch in self.guild.channels.values() if getattr(ch, "category_id", None) == self.id]
+
+
+class FakeGuild:
+    def __init__(self, http: FakeHTTP, on_message):
+        self.id = main.GUILD_ID
+        self.http = http
+        self.on_message = on_message
+        self.ids = iter(range(10_000_000, 100_000_000))
+        self.default_role = FakeRole(self.id, "@everyone")
+        self.roles = [self.default_role] + [FakeRole(next(self.ids), r[2]) for r in main.rank_roles]
+        self.members = {}
+        self.channels = {}
+        self.me = self.add_member(next(self.ids), "kurisu-bot", bot=True)
+        self.channels[main.BATTLE_CATEGORY_ID] = FakeCategory(self, main.BATTLE_CATEGORY_ID)
+        for ch_id in [main.BATTLELOG_CHANNEL_ID, main.ACTIVE_LOG_CHANNEL_ID, main.JUDGE_CHANNEL_ID, main.MATCHING_CHANNEL_ID]:
+            self.channels[ch_id] = FakeTextChannel(self, ch_id, f"ch-{ch_id}")
+
+    def add_member(self, member_id: int, name: str, bot: bool = False):
+        member = FakeMember(self, member_id, name, bot=bot)
+        self.members[member_id] = member
+        return member
+
+    @property
+    def text_channels(self):
+        return [ch for ch in self.channels.values() if isinstance(ch, FakeTextChannel)]
+
+    def get_member(self, member_id: int):
+        return self.members.get(member_id)
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+    def get_role(self, role_id: int):
+        return next((r for r in self.roles if r.id == role_id), None)
+
+    async def create_text_channel(self, name: str, category=None, overwrites=None):
+        await self.http.request("POST /guilds/{guild_id}/channels")
+        ch = FakeTextChannel(self, next(self.ids), name, category.id if category else None)
+        ch.overwrites = overwrites or {}
+        self.channels[ch.id] = ch
+        return ch
+
+
+class FakeInteractionResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+
+    async def send_message(self, content=None, ephemeral=False, view=None):
+        await self.interaction.guild.http.request("POST /interactions/{id}/{token}/callback")
+        self.done = True
+
+    async def defer(self, ephemeral=False, thinking=False):
+        await self.interaction.guild.http.request("POST /interactions/{id}/{token}/callback")
+        self.done = True
+
+    async def edit_message(self, content=None, view=None):
+        await self.interaction.guild.http.request("POST /interactions/{id}/{token}/callback")
+        self.done = True
+
+
+class FakeInteraction:
+    def __init__(self, guild: FakeGuild, user: FakeMember, channel: FakeTextChannel):
+        self.guild = guild
+        self.user = user
+        self.channel = channel
+        self.response = FakeInteractionResponse(self)
+        self.original_content = None
+
+    async def edit_original_response(self, content=None, view=None):
+        await self.guild.http.request("PATCH /webhooks/{application_id}/{token}/messages/@original")
+        self.original_content = content
+
+
+# ----------------------------------------
+# シミュレーション本体
+# ----------------------------------------
+class LoadSimulation:
+    def __init__(self, args):
+        self.args = args
+        self.http = FakeHTTP(args.latency_ms / 1000, args.jitter_ms / 1000, args.rate_limit_prob, args.retry_after)
+        self.guild = FakeGuild(self.http, self.on_message)
+        self.players = [self.guild.add_member(1000 + i, f"player{i}") for i in range(args.players)]
+        self.joined_at = {}
+        self.match_latencies = []
+        self.matches = 0
+        self.games = []
+        self.loop_lags = []
+        self.remaining_rounds = {p.id: args.rounds for p in self.players}
+        self.pending_rejoins = 0
+        self.active_games = 0
+
+    def install(self):
+        main.bot.get_guild = lambda guild_id: self.guild
+        main.bot.get_channel = self.guild.get_channel
+        main.BATTLE_CLOSE_DELAY = self.args.close_delay
+        main.display_sync.window = self.args.display_window
+        main.match_scheduler.debounce = self.args.debounce
+        main.match_scheduler.max_latency = self.args.max_latency
+        main.battle_pool.min_size = self.args.pool_min
+        main.battle_pool.max_size = max(self.args.pool_min, self.args.pool_max)
+        for p in self.players:
+            main.set_user_pt(p.id, random.randrange(0, 30))
+
+    def on_message(self, channel, msg):
+        # 降参ボタン付きの開始メッセージ = マッチ成立
+        view = msg.view
+        if isinstance(view, main.ForfeitView):
+            now = asyncio.get_running_loop().time()
+            for uid in (view.user1, view.user2):
+                self.match_latencies.append(now - self.joined_at.pop(uid, now))
+            self.matches += 1
+            self.active_games += 1
+            self.games.append(asyncio.create_task(self.play(view.user1, view.user2, channel.id)))
+
+    async def join(self, member: FakeMember):
+        self.joined_at[member.id] = asyncio.get_running_loop().time()
+        interaction = FakeInteraction(self.guild, member, self.guild.get_channel(main.MATCHING_CHANNEL_ID))
+        await main.start_match_wish(interaction)
+
+    async def play(self, u1: int, u2: int, channel_id: int):
+        await asyncio.sleep(self.args.game_seconds * (0.5 + random.random()))
+        winner, loser = (u1, u2) if random.random() < 0.5 else (u2, u1)
+        try:
+            await main.settlement.settle(winner, loser, self.guild, channel_id)
+        finally:
+            # 対戦中の数は matching ではなく自前で数える（再参加の予約までを1試合とする）
+            for uid in (u1, u2):
+                self.remaining_rounds[uid] -= 1
+                if self.remaining_rounds[uid] > 0:
+                    self.pending_rejoins += 1
+                    asyncio.create_task(self.rejoin(uid))
+            self.active_games -= 1
+
+    async def rejoin(self, uid: int):
+        await asyncio.sleep(random.random() * self.args.think_seconds)
+        try:
+            await self.join(self.guild.get_member(uid))
+        finally:
+            # 応答の REST 待ちの間に「全員終了」と誤判定しないよう、request 後に減らす
+            self.pending_rejoins -= 1
+
+    async def wait_finished(self):
+        """対戦中の人も再参加待ちの人もおらず、マッチング処理の予定も無くなったら終了"""
+        while True:
+            await asyncio.sleep(0.2)
+            if not main.matching and self.active_games == 0 and self.pending_rejoins == 0 and main.match_scheduler.first_request is None:
+                return
+
+    async def monitor_loop_lag(self, interval: float = 0.01):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lags.append(loop.time() - started - interval)
+
+    async def run(self):
+        self.install()
+        main.battle_pool.start(self.guild)
+        monitor = asyncio.create_task(self.monitor_loop_lag())
+        started = time.perf_counter()
+        # 全員がバースト窓の中でほぼ同時に /マッチ希望
+        async def burst_join(member):
+            await asyncio.sleep(random.random() * self.args.burst_seconds)
+            await self.join(member)
+        await asyncio.gather(*(burst_join(p) for p in self.players))
+        try:
+            await asyncio.wait_for(self.wait_finished(), timeout=self.args.timeout)
+        except asyncio.TimeoutError:
+            print(f"[WARN] {self.args.timeout}s 以内に全試合が終わりませんでした（待機中 {len(main.waiting_list)} 人）")
+        await asyncio.sleep(self.args.close_delay + self.args.display_window + 0.5)
+        await main.log_sink.flush()
+        elapsed = time.perf_counter() - started
+        monitor.cancel()
+        self.report(elapsed)
+
+    def report(self, elapsed: float):
+        calls = sum(self.http.calls.values())
+        print(f"players={self.args.players} rounds={self.args.rounds} matches={self.matches} "
+              f"unmatched={len(main.waiting_list)} elapsed={elapsed:.1f}s")
+        print(f"match latency: p50 {percentile(self.match_latencies, 0.5):.2f}s  p95 {percentile(self.match_latencies, 0.95):.2f}s  "
+              f"p99 {percentile(self.match_latencies, 0.99):.2f}s  max {max(self.match_latencies, default=0):.2f}s")
+        print(f"REST calls: {calls} total / {calls / self.matches if self.matches else 0:.1f} per match / "
+              f"429 {sum(self.http.rate_limited.values())}")
+        for route, n in self.http.calls.most_common():
+            print(f"  {n:7d}  {route}  (429: {self.http.rate_limited[route]})")
+        print(f"event loop lag: p50 {percentile(self.loop_lags, 0.5)*1000:.1f}ms  p99 {percentile(self.loop_lags, 0.99)*1000:.1f}ms  "
+              f"max {max(self.loop_lags, default=0)*1000:.1f}ms")
+        st = main.match_scheduler.stats()
+        print(f"matchmaking: {st['passes']} passes / {st['requests_per_pass']:.1f} requests per pass / "
+              f"pass max {st['pass_max']*1000:.1f}ms")
+        for name, rs in main.rest.summary().items():
+            print(f"rest[{name}]: done {rs['done']} failed {rs['failed']} wait avg {rs['wait_avg']*1000:.1f}ms max {rs['wait_max']*1000:.1f}ms")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="main.py のオフライン負荷シミュレーション")
+    parser.add_argument("--players", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=2, help="1人あたりの試合数")
+    parser.add_argument("--burst-seconds", type=float, default=2.0, help="最初の /マッチ希望 が集中する秒数")
+    parser.add_argument("--game-seconds", type=float, default=2.0, help="1試合の平均秒数")
+    parser.add_argument("--think-seconds", type=float, default=1.0, help="試合後に再度マッチ希望するまでの最大秒数")
+    parser.add_argument("--latency-ms", type=float, default=30.0, help="REST 呼び出し1回の基本遅延")
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--rate-limit-prob", type=float, default=0.01, help="REST 呼び出しが 429 になる確率")
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    parser.add_argument("--debounce", type=float, default=main.MATCH_DEBOUNCE_SECONDS)
+    parser.add_argument("--max-latency", type=float, default=main.MATCH_MAX_LATENCY_SECONDS)
+    parser.add_argument("--display-window", type=float, default=0.5)
+    parser.add_argument("--close-delay", type=float, default=0.5, help="BATTLE_CLOSE_DELAY の代わりに使う秒数")
+    parser.add_argument("--pool-min", type=int, default=main.BATTLE_POOL_MIN)
+    parser.add_argument("--pool-max", type=int, default=main.BATTLE_POOL_MAX)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    asyncio.run(LoadSimulation(args).run())
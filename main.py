@@ -5,6 +5,30 @@ from discord import app_commands
 from discord.ext import commands
 from datetime import datetime, timedelta, timezone
 import random
+import math
+import sqlite3
+import struct
+import mmap
+import time
+import heapq
+import signal
+import itertools
+import bisect
+import array
+import logging
+import json
+import hashlib
+import contextlib
+import csv
+import gzip
+import shutil
+import tempfile
+from collections import deque, OrderedDict
+
+try:
+    import numpy as np  # 任意：レーティング一括再計算で使用
+except ImportError:
+    np = None
 
 # ----------------------------------------
 # 環境変数
@@ -17,19 +41,575 @@ JUDGE_CHANNEL_ID = int(os.environ["JUDGE_CHANNEL_ID"])
 MATCHING_CHANNEL_ID = int(os.environ["MATCHING_CHANNEL_ID"])
 BATTLELOG_CHANNEL_ID = int(os.environ["BATTLELOG_CHANNEL_ID"])
 BATTLE_CATEGORY_ID = 1427541907579605012
+NOTICE_CHANNEL_ID = 1427835216830926958  # #お知らせ
 ACTIVE_LOG_CHANNEL_ID = int(os.environ.get("ACTIVE_LOG_CHANNEL_ID", "0"))
+DB_PATH = os.environ.get("DB_PATH", "kurisu.db")
+COMMAND_SYNC_SCOPE = os.environ.get("COMMAND_SYNC_SCOPE", "guild")  # guild: GUILD_ID にだけ登録（即時反映） / global: 全体に登録
+PT_FLUSH_SECONDS = float(os.environ.get("PT_FLUSH_SECONDS", "2"))  # pt 書き込みをまとめる秒数
+SESSION_FLUSH_SECONDS = float(os.environ.get("SESSION_FLUSH_SECONDS", "0.2"))  # 待機・対戦状態の書き込みをまとめる秒数
+HISTORY_PATH = os.environ.get("HISTORY_PATH", "history.bin")
+HISTORY_SNAPSHOT_EVERY = int(os.environ.get("HISTORY_SNAPSHOT_EVERY", "10000"))  # この件数ごとにスナップショットを書く
+RATING_ENGINE = os.environ.get("RATING_ENGINE", "plusminus")  # plusminus / elo / glicko2
+DISPLAY_SYNC_SECONDS = float(os.environ.get("DISPLAY_SYNC_SECONDS", "1"))  # 同じメンバーの表示更新をまとめる秒数
+BULK_DISPLAY_WORKERS = int(os.environ.get("BULK_DISPLAY_WORKERS", "4"))     # 一括表示更新の同時実行数
+RANKING_PAGE_SIZE = int(os.environ.get("RANKING_PAGE_SIZE", "20"))          # /ランキング 1ページの行数
+BATTLE_POOL_MIN = int(os.environ.get("BATTLE_POOL_MIN", "4"))               # 待機させておく対戦チャンネル数
+BATTLE_POOL_MAX = int(os.environ.get("BATTLE_POOL_MAX", "16"))              # 待機チャンネルの上限（超えた分は削除）
+LOG_FLUSH_SECONDS = float(os.environ.get("LOG_FLUSH_SECONDS", "3"))         # ログ投稿をまとめる秒数
+LOG_FLUSH_LINES = int(os.environ.get("LOG_FLUSH_LINES", "20"))              # この行数溜まったら即投稿
+LOG_BUFFER_MAX = int(os.environ.get("LOG_BUFFER_MAX", "1000"))              # チャンネルごとのバッファ上限（超えたら古い行を捨てる）
+REST_CONCURRENCY = int(os.environ.get("REST_CONCURRENCY", "8"))             # REST 呼び出しの同時実行数
+REST_ROUTE_CONCURRENCY = int(os.environ.get("REST_ROUTE_CONCURRENCY", "2")) # 同じ route への同時実行数
+LAZY_MEMBERS = os.environ.get("LAZY_MEMBERS", "0") == "1"                  # 1 なら起動時にメンバー一覧を取らず、必要な分だけ取得する（大規模サーバー向け）
+MEMBER_CACHE_SIZE = int(os.environ.get("MEMBER_CACHE_SIZE", "2000"))        # LAZY_MEMBERS で取得したメンバーを保持する数
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))                     # /metrics を公開するポート（0 なら無効）
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")                  # /metrics の待ち受けアドレス
 
 JST = timezone(timedelta(hours=+9))
 AUTO_APPROVE_SECONDS = 300  # 5分
+WAITING_SECONDS = 300       # マッチ希望の待機時間
+BATTLE_CLOSE_DELAY = 10     # 結果確定から対戦チャンネルを閉じるまでの秒数
+PT_MAX = 1_000_000          # pt の上限（/admin_set_pt で設定できる最大値。履歴は int32 で記録する）
+MATCH_DEBOUNCE_SECONDS = float(os.environ.get("MATCH_DEBOUNCE_SECONDS", "2"))        # 最後のマッチ希望からこの秒数静かになったらマッチング
+MATCH_MAX_LATENCY_SECONDS = float(os.environ.get("MATCH_MAX_LATENCY_SECONDS", "5"))  # 最初のマッチ希望からの最大待ち秒数
+MATCH_MODE = os.environ.get("MATCH_MODE", "random")  # random: ランダムに組む / batch: 待機者全体で最小コストの組み合わせを解く
 
 # ----------------------------------------
 # 内部データ
 # ----------------------------------------
-user_data = {}           # user_id -> {"pt": int}
+class PlayerStore:
+    """
+    登録ユーザーの pt を並列配列で持つ（1人ごとの dict を作らない）
+    - index: user_id -> 配列の位置、ids / pts: 位置ごとの user_id と pt（int64）
+    - 登録順は保たれ、削除はしない（全体リセットも pt を 0 にするだけ）
+    - 読みは get_user_pt、書きは ledger（PtLedger）を通す（pt_store 等への反映は set_user_pts）
+    """
+    __slots__ = ("index", "ids", "pts")
+
+    def __init__(self):
+        self.index = {}
+        self.ids = array.array("q")
+        self.pts = array.array("q")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, user_id: int):
+        return user_id in self.index
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def get_pt(self, user_id: int, default: int = 0) -> int:
+        i = self.index.get(user_id)
+        return default if i is None else self.pts[i]
+
+    def set_pt(self, user_id: int, pt: int):
+        i = self.index.get(user_id)
+        if i is None:
+            self.index[user_id] = len(self.ids)
+            self.ids.append(user_id)
+            self.pts.append(pt)
+        else:
+            self.pts[i] = pt
+
+    def set_many(self, items):
+        for user_id, pt in items:
+            self.set_pt(user_id, pt)
+
+    def items(self):
+        return zip(self.ids, self.pts)
+
+    def to_dict(self) -> dict:
+        return dict(zip(self.ids, self.pts))
+
+    def copy(self) -> "PlayerStore":
+        """別スレッドで読むための複製（配列のコピーだけなので速い）"""
+        other = PlayerStore()
+        other.index = self.index.copy()
+        other.ids = self.ids[:]
+        other.pts = self.pts[:]
+        return other
+
+    def sorted_by_pt(self, reverse: bool = True):
+        """(user_id, pt) を pt 順に返す（同点は登録順）"""
+        order = sorted(range(len(self.pts)), key=self.pts.__getitem__, reverse=reverse)
+        ids, pts = self.ids, self.pts
+        return [(ids[i], pts[i]) for i in order]
+
+player_store = PlayerStore()  # user_id -> pt
 matching = {}            # 現在マッチ中のプレイヤー組
-waiting_list = {}        # user_id -> {"expires": datetime, "task": asyncio.Task, "interaction": discord.Interaction}
+waiting_list = {}        # user_id -> {"expires": datetime(参加時点の期限), "joined": float(loop.time), "interaction": discord.Interaction}
 matching_channels = {}   # user_id -> 専用チャンネルID
 
+# ----------------------------------------
+# 永続化（SQLite）
+# ----------------------------------------
+class PointStore:
+    """
+    player_store の pt を SQLite（WALモード）に保存する
+    - 読み込みは起動時の load() だけ（以降はメモリ上の player_store を参照）
+    - 書き込みは mark_dirty() で溜めておき、PT_FLUSH_SECONDS ごとにまとめて別スレッドで書く
+    - レーティング方式が pt 以外に持つ状態（Glicko-2 の RD など）も rating_state に同じトランザクションで書く
+    """
+    def __init__(self, path: str, flush_seconds: float):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.conn = None
+        self.dirty = set()
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS user_pt (user_id INTEGER PRIMARY KEY, pt INTEGER NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS rating_state (user_id INTEGER PRIMARY KEY, mu REAL NOT NULL, phi REAL NOT NULL, sigma REAL NOT NULL)")
+        self.conn.commit()
+
+    def load(self) -> list:
+        return self.conn.execute("SELECT user_id, pt FROM user_pt").fetchall()
+
+    def load_rating_state(self) -> list:
+        return self.conn.execute("SELECT user_id, mu, phi, sigma FROM rating_state").fetchall()
+
+    def get_meta(self, key: str):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def mark_dirty(self, *user_ids: int):
+        self.dirty.update(user_ids)
+        if self.conn is None:
+            return
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(self.flush_seconds)  # この間の変更をまとめて書く
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if not self.dirty or self.conn is None:
+                return
+            rows = [(uid, get_user_pt(uid)) for uid in self.dirty]
+            states = rating_engine.export_state(self.dirty)
+            self.dirty.clear()
+            try:
+                await asyncio.to_thread(self._write, rows, states)
+            except Exception as e:
+                print(f"[ERROR] pt の保存に失敗しました: {e}")
+                self.dirty.update(uid for uid, _ in rows)
+
+    def _write(self, rows, states=()):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO user_pt (user_id, pt) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET pt = excluded.pt",
+                rows
+            )
+            if states:
+                self.conn.executemany(
+                    "INSERT INTO rating_state (user_id, mu, phi, sigma) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET mu = excluded.mu, phi = excluded.phi, sigma = excluded.sigma",
+                    states
+                )
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        await self.flush()
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+pt_store = PointStore(DB_PATH, PT_FLUSH_SECONDS)
+
+class SessionStore:
+    """
+    待機中・対戦中・結果承認待ちの状態を SQLite に保存し、再起動後に restore_sessions() で戻す
+    - 状態が変わるたびに該当行だけ dirty にして、flush_seconds 後にまとめて別スレッドで書く（PointStore と同じ作り）
+    - 期限は再起動をまたぐので loop.time ではなく time.time() で持つ
+    """
+    TABLES = {
+        "waiting": ("session_waiting", "user_id", ("deadline",)),
+        "match": ("session_match", "channel_id", ("user1", "user2", "disputed")),
+        "result": ("session_result", "channel_id", ("winner", "loser", "deadline")),
+    }
+
+    def __init__(self, path: str, flush_seconds: float):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.conn = None
+        # 書き込む内容のミラー（kind -> {key: 行}）と、変更のあったキー
+        self.rows = {kind: {} for kind in self.TABLES}
+        self.dirty = set()  # (kind, key)
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS session_waiting (user_id INTEGER PRIMARY KEY, deadline REAL NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS session_match (channel_id INTEGER PRIMARY KEY, user1 INTEGER NOT NULL, user2 INTEGER NOT NULL, disputed INTEGER NOT NULL DEFAULT 0)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS session_result (channel_id INTEGER PRIMARY KEY, winner INTEGER NOT NULL, loser INTEGER NOT NULL, deadline REAL NOT NULL)")
+        self.conn.commit()
+
+    def load(self) -> dict:
+        result = {}
+        for kind, (table, key, cols) in self.TABLES.items():
+            rows = self.conn.execute(f"SELECT {key}, {', '.join(cols)} FROM {table}").fetchall()
+            self.rows[kind] = {row[0]: tuple(row[1:]) for row in rows}
+            result[kind] = dict(self.rows[kind])
+        return result
+
+    # --- 状態遷移（呼ぶ側は同期でよい） ---
+    def waiting_added(self, user_id: int, deadline: float):
+        self._set("waiting", user_id, (deadline,))
+
+    def waiting_removed(self, user_id: int):
+        self._set("waiting", user_id, None)
+
+    def match_started(self, channel_id: int, user1: int, user2: int):
+        self._set("match", channel_id, (user1, user2, 0))
+
+    def match_disputed(self, channel_id: int):
+        row = self.rows["match"].get(channel_id)
+        if row:
+            self._set("match", channel_id, (row[0], row[1], 1))
+        self._set("result", channel_id, None)
+
+    def match_ended(self, channel_id: int):
+        self._set("match", channel_id, None)
+        self._set("result", channel_id, None)
+
+    def result_reported(self, channel_id: int, winner: int, loser: int, deadline: float):
+        self._set("result", channel_id, (winner, loser, deadline))
+
+    def result_cleared(self, channel_id: int):
+        self._set("result", channel_id, None)
+
+    def _set(self, kind: str, key: int, row):
+        if row is None:
+            if key not in self.rows[kind]:
+                return
+            del self.rows[kind][key]
+        else:
+            self.rows[kind][key] = row
+        self.dirty.add((kind, key))
+        if self.conn is None:
+            return
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(self.flush_seconds)
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if not self.dirty or self.conn is None:
+                return
+            keys = list(self.dirty)
+            self.dirty.clear()
+            ops = [(kind, key, self.rows[kind].get(key)) for kind, key in keys]
+            try:
+                await asyncio.to_thread(self._write, ops)
+            except Exception as e:
+                print(f"[ERROR] 対戦状態の保存に失敗しました: {e}")
+                self.dirty.update(keys)
+
+    def _write(self, ops):
+        with self.conn:
+            for kind, key, row in ops:
+                table, key_col, cols = self.TABLES[kind]
+                if row is None:
+                    self.conn.execute(f"DELETE FROM {table} WHERE {key_col} = ?", (key,))
+                else:
+                    self.conn.execute(
+                        f"INSERT OR REPLACE INTO {table} ({key_col}, {', '.join(cols)}) VALUES ({', '.join('?' * (len(cols) + 1))})",
+                        (key, *row)
+                    )
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        await self.flush()
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+session_store = SessionStore(DB_PATH, SESSION_FLUSH_SECONDS)
+
+# ----------------------------------------
+# 対戦・pt 変動履歴（追記専用バイナリログ）
+# ----------------------------------------
+HISTORY_RESULT = 1       # a=勝者 b=敗者
+HISTORY_FORFEIT = 2      # a=勝者 b=降参した側
+HISTORY_TRANSFER = 3     # a=送信者 b=受信者
+HISTORY_ADMIN_SET = 4    # a=対象（b なし）
+HISTORY_ADMIN_RESET = 5  # 全員 0pt
+
+# kind, 時刻(UNIX秒), user_a, user_b, 変更後pt_a, 変更後pt_b（32バイト固定長）
+HISTORY_RECORD = struct.Struct("<B3xIQQii")
+# スナップショット: ヘッダー（対応するログの位置, 人数）+ (user_id, pt) の並び
+SNAPSHOT_HEADER = struct.Struct("<QQ")
+SNAPSHOT_ENTRY = struct.Struct("<Qq")
+
+class HistoryLog:
+    """
+    pt を変える出来事をすべて固定長レコードで追記する
+    - 変更後の pt をそのまま記録するので、再生は「同じユーザーは最後の値が勝つ」だけで済む
+    - 追記はメモリに溜めて別スレッドで書き込む
+    - snapshot_every 件ごとにその時点の全員の pt をスナップショットとして保存し、再生はその続きからだけ行う
+    - 再生は mmap したファイルを列ごとに取り出して dict にまとめるので 1 件ずつ unpack しない
+    """
+    def __init__(self, path: str, snapshot_every: int):
+        self.path = path
+        self.snapshot_path = path + ".snap"
+        self.snapshot_every = snapshot_every
+        self.file = None
+        self.size = 0            # 書き込み済みのバイト数
+        self.pending = bytearray()
+        self.since_snapshot = 0
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def open(self, current: dict):
+        self.file = open(self.path, "ab", buffering=0)  # 書き込み失敗時にバッファへ残らないように
+        self.size = self.file.tell()
+        # 途中で落ちて書きかけになったレコードは捨てる
+        if self.size % HISTORY_RECORD.size:
+            self.size -= self.size % HISTORY_RECORD.size
+            self.file.truncate(self.size)
+        if not os.path.exists(self.snapshot_path) and self.size == 0 and current:
+            # 履歴を取り始める前の pt を起点として保存しておく
+            self._write_snapshot(0, current)
+
+    @staticmethod
+    def pack(kind: int, user_a: int, user_b: int = 0, pt_a: int = 0, pt_b: int = 0) -> bytes:
+        """
+        1件分のレコードを作る。pt が int32 に収まらないなど書けない値なら ValueError
+        状態を変える前に呼んでおき、append_packed() で追記する（記録できない変更を先に反映しないように）
+        """
+        try:
+            return HISTORY_RECORD.pack(kind, int(time.time()), user_a, user_b, pt_a, pt_b)
+        except struct.error as e:
+            raise ValueError(f"履歴に記録できない値です: kind={kind} a={user_a} b={user_b} pt_a={pt_a} pt_b={pt_b} ({e})") from e
+
+    def append_packed(self, data: bytes):
+        if not data:
+            return
+        self.pending += data
+        self.since_snapshot += len(data) // HISTORY_RECORD.size
+        if self.file is None:
+            return
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(1)
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if not self.pending or self.file is None:
+                return
+            data = bytes(self.pending)
+            self.pending.clear()
+            snapshot = None
+            if self.since_snapshot >= self.snapshot_every:
+                # 今の player_store は data まで反映済みの状態なので同じ位置で切る
+                snapshot = (self.size + len(data), player_store.to_dict())
+            try:
+                await asyncio.to_thread(self._write, data, self.size)
+            except Exception as e:
+                print(f"[ERROR] 履歴の書き込みに失敗しました（次回再試行します）: {e}")
+                # 失敗した分は先頭に戻す（待っている間に追記された分より前）
+                self.pending[:0] = data
+                self.wakeup.set()
+                return
+            self.size += len(data)
+            if snapshot:
+                self.since_snapshot = 0
+                try:
+                    await asyncio.to_thread(self._write_snapshot, *snapshot)
+                except Exception as e:
+                    print(f"[ERROR] 履歴スナップショットの保存に失敗しました: {e}")
+
+    def _write(self, data: bytes, offset: int):
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[self.file.write(view):]
+            os.fsync(self.file.fileno())
+        except Exception:
+            # 途中まで書けた分を切り戻す（再試行で同じレコードが二重にならないように）
+            with contextlib.suppress(OSError):
+                self.file.truncate(offset)
+            raise
+
+    def _write_snapshot(self, offset: int, pts: dict):
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(offset, len(pts)))
+            for uid, pt in pts.items():
+                f.write(SNAPSHOT_ENTRY.pack(uid, pt))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        await self.flush()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def replay(self) -> dict:
+        """スナップショット + それ以降のログから user_id -> pt を組み立てる（ディスク上の内容のみ）"""
+        pts, offset = self._load_snapshot()
+        if not os.path.exists(self.path):
+            return pts
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            size -= size % HISTORY_RECORD.size
+            if size <= offset:
+                return pts
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    self._replay_records(view[offset:size], pts)
+                finally:
+                    view.release()
+        return pts
+
+    def _load_snapshot(self):
+        if not os.path.exists(self.snapshot_path) or os.path.getsize(self.snapshot_path) < SNAPSHOT_HEADER.size:
+            return {}, 0
+        with open(self.snapshot_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset, count = SNAPSHOT_HEADER.unpack_from(mm, 0)
+            view = memoryview(mm)
+            try:
+                body = view[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + count * SNAPSHOT_ENTRY.size].cast("q")
+                pts = dict(zip(body[0::2].tolist(), body[1::2].tolist()))
+                body.release()
+            finally:
+                view.release()
+        return pts, offset
+
+    def iter_records(self, end: int = None, chunk_records: int = 4096):
+        """
+        ログのレコードを先頭から (kind, 時刻, user_a, user_b, pt_a, pt_b) で順に返す（別スレッド用）
+        - end（バイト）までしか読まないので、読んでいる間に追記されても途中のレコードは混ざらない
+        - chunk_records 件ずつ読むのでファイルの大きさによらずメモリは一定
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if end is not None:
+                size = min(size, end)
+            size -= size % HISTORY_RECORD.size
+            remaining = size
+            while remaining > 0:
+                data = f.read(min(remaining, chunk_records * HISTORY_RECORD.size))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield from HISTORY_RECORD.iter_unpack(data)
+
+    def read_matches(self):
+        """最後の全体リセット以降の対戦（結果・降参）を時系列順に (勝者リスト, 敗者リスト) で返す"""
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < HISTORY_RECORD.size:
+            return [], []
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            size -= size % HISTORY_RECORD.size
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                words = view.cast("Q")
+                try:
+                    kinds = bytes(view[0::HISTORY_RECORD.size])
+                    users_a = words[1::4].tolist()
+                    users_b = words[2::4].tolist()
+                finally:
+                    words.release()
+                    view.release()
+        start = kinds.rfind(HISTORY_ADMIN_RESET) + 1
+        winners = []
+        losers = []
+        for i in range(start, len(kinds)):
+            if kinds[i] in (HISTORY_RESULT, HISTORY_FORFEIT):
+                winners.append(users_a[i])
+                losers.append(users_b[i])
+        return winners, losers
+
+    @staticmethod
+    def _replay_records(view: memoryview, pts: dict):
+        """
+        レコード列を列ごとに取り出して反映する
+        32バイトのレコードを 8 バイト単位で見ると [kind+時刻, user_a, user_b, pt_a+pt_b]、4 バイト単位では pt_a/pt_b が 6, 7 番目
+        """
+        words = view.cast("Q")
+        ints = view.cast("i")
+        kinds = bytes(view[0::HISTORY_RECORD.size])
+        users_a = words[1::4].tolist()
+        users_b = words[2::4].tolist()
+        pts_a = ints[6::8].tolist()
+        pts_b = ints[7::8].tolist()
+        words.release()
+        ints.release()
+
+        start = 0
+        last_reset = kinds.rfind(HISTORY_ADMIN_RESET)
+        if last_reset >= 0:
+            # 最後の全体リセットより前は「その時点で存在した人が 0pt」になるだけ
+            known = set(pts)
+            known.update(users_a[:last_reset])
+            known.update(users_b[:last_reset])
+            known.discard(0)
+            pts.clear()
+            pts.update(dict.fromkeys(known, 0))
+            start = last_reset + 1
+
+        # user_a, user_b を交互に並べて dict に流し込む（後のレコードが優先される）
+        n = len(kinds) - start
+        users = [0] * (2 * n)
+        values = [0] * (2 * n)
+        users[0::2] = users_a[start:]
+        users[1::2] = users_b[start:]
+        values[0::2] = pts_a[start:]
+        values[1::2] = pts_b[start:]
+        pts.update(zip(users, values))
+        # user_b を使わないレコード（b=0）の分を取り除く
+        pts.pop(0, None)
+
+history_log = HistoryLog(HISTORY_PATH, HISTORY_SNAPSHOT_EVERY)
+
 # ========================================
 # イベント設定
 # ========================================
@@ -64,52 +644,1553 @@ rank_ranges_internal = {
     6: range(25, 10000),
 }
 
+RANK_TABLE_CAP = 4096  # この pt 未満は表引き、以上は二分探索
+
+class RankTable:
+    """
+    pt の区間 -> 値 を起動時に表にしておく
+    - 0 <= pt < cap は配列の添字1回で引く
+    - それ以外（負の pt や cap 以上）は区間の開始 pt を bisect で探す
+    """
+    def __init__(self, tiers, default, cap: int = RANK_TABLE_CAP):
+        tiers = sorted(tiers)  # (開始 pt, 終了 pt（含む）, 値)
+        self.default = default
+        self.starts = [start for start, _, _ in tiers]
+        self.ends = [end for _, end, _ in tiers]
+        self.values = [value for _, _, value in tiers]
+        self.table = [self._search(pt) for pt in range(cap)]
+
+    def _search(self, pt: int):
+        i = bisect.bisect_right(self.starts, pt) - 1
+        if i >= 0 and pt <= self.ends[i]:
+            return self.values[i]
+        return self.default
+
+    def lookup(self, pt: int):
+        if 0 <= pt < len(self.table):
+            return self.table[pt]
+        return self._search(pt)
+
+rank_info_table = RankTable([(start, end, (role, icon)) for start, end, role, icon in rank_roles], ("Unknown", "❓"))
+internal_rank_table = RankTable([(r.start, r.stop - 1, rank) for rank, r in rank_ranges_internal.items()], 1)
+
+# ----------------------------------------
+# 順位インデックス
+# ----------------------------------------
+class RankIndex:
+    """
+    pt ごとの人数を Fenwick 木で持ち、同点同順位の順位を O(log n) で返す
+    - 木の添字は出現した pt の値を昇順に並べた位置（座標圧縮）なので、pt の大きさではなく値の種類数ぶんしかメモリを使わない
+    - set() は pt が変わった1人分だけ更新する
+    - 初めて出る値が来たときだけ値の並びに挿入して作り直す（O(種類数)、人数がいなくなった値はこのとき捨てる）
+    """
+    def __init__(self):
+        self.keys = []     # 出現した pt の値（昇順）。tree の index i は keys[i]
+        self.counts = {}   # pt -> 人数
+        self.tree = [0]
+        self.pts = {}      # user_id -> pt
+
+    def __len__(self):
+        return len(self.pts)
+
+    def _add(self, i: int, delta: int):
+        i += 1
+        size = len(self.keys)
+        while i <= size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def _count_below(self, i: int) -> int:
+        """index が i 未満の人数"""
+        i = max(0, min(i, len(self.keys)))
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def _build(self):
+        self.keys = [pt for pt in self.keys if self.counts.get(pt)]
+        self.counts = {pt: self.counts[pt] for pt in self.keys}
+        size = len(self.keys)
+        tree = [0] * (size + 1)
+        for i, pt in enumerate(self.keys, 1):
+            tree[i] += self.counts[pt]
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def rebuild(self, items):
+        self.pts = dict(items)
+        self.counts = {}
+        for pt in self.pts.values():
+            self.counts[pt] = self.counts.get(pt, 0) + 1
+        self.keys = sorted(self.counts)
+        self._build()
+
+    def set(self, user_id: int, pt: int):
+        old = self.pts.get(user_id)
+        if old == pt:
+            return
+        self.pts[user_id] = pt
+        if old is not None:
+            self.counts[old] -= 1
+        if pt in self.counts:
+            self.counts[pt] += 1
+            if old is not None:
+                self._add(bisect.bisect_left(self.keys, old), -1)
+            self._add(bisect.bisect_left(self.keys, pt), 1)
+        else:
+            self.counts[pt] = 1
+            bisect.insort(self.keys, pt)
+            self._build()
+
+    def rank_of_pt(self, pt: int) -> int:
+        """pt を持つ人の順位（自分より pt が高い人数 + 1）"""
+        return len(self.pts) - self._count_below(bisect.bisect_right(self.keys, pt)) + 1
+
+    def rank(self, user_id: int):
+        pt = self.pts.get(user_id)
+        if pt is None:
+            return None
+        return self.rank_of_pt(pt)
+
+rank_index = RankIndex()
+
+# ----------------------------------------
+# メトリクス（Prometheus テキスト形式）
+# ----------------------------------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    """累積バケットのヒストグラム（observe は bisect 1回と加算だけ）"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最後は +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """
+    カウンタ・ヒストグラム・ゲージを溜めて /metrics で返す
+    - カウンタとヒストグラムは (名前, ラベル) ごとにメモリ上で加算するだけ
+    - ゲージは登録した関数を出力時に呼ぶので、普段の処理には何も足さない
+    """
+    def __init__(self):
+        self.help = {}        # name -> (type, help)
+        self.counters = {}    # name -> {labels(tuple): float}
+        self.histograms = {}  # name -> {labels(tuple): Histogram}
+        self.gauges = {}      # name -> 値を返す関数（dict を返せば {labels: 値}）
+        self.rest_inflight = {}  # url -> route（429 の警告ログを route に対応付ける）
+        self.runner = None
+        self.lag_task = None
+
+    def counter(self, name: str, help_text: str):
+        self.help[name] = ("counter", help_text)
+        self.counters.setdefault(name, {})
+
+    def histogram(self, name: str, help_text: str):
+        self.help[name] = ("histogram", help_text)
+        self.histograms.setdefault(name, {})
+
+    def gauge(self, name: str, help_text: str, func):
+        self.help[name] = ("gauge", help_text)
+        self.gauges[name] = func
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        series = self.counters[name]
+        series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name: str, value: float, labels: tuple = ()):
+        series = self.histograms[name]
+        hist = series.get(labels)
+        if hist is None:
+            hist = series[labels] = Histogram()
+        hist.observe(value)
+
+    # --- 出力 ---
+    @staticmethod
+    def _labels(labels: tuple) -> str:
+        parts = []
+        for key, value in labels:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            parts.append(f'{key}="{value}"')
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text) in self.help.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for labels, value in self.counters[name].items():
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+            elif kind == "histogram":
+                for labels, hist in self.histograms[name].items():
+                    cumulative = 0
+                    for bound, n in zip(hist.buckets, hist.counts):
+                        cumulative += n
+                        lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {hist.count}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {hist.sum}")
+                    lines.append(f"{name}_count{self._labels(labels)} {hist.count}")
+            else:
+                try:
+                    value = self.gauges[name]()
+                except Exception as e:
+                    print(f"[ERROR] メトリクス {name} の取得に失敗しました: {e}")
+                    continue
+                if isinstance(value, dict):
+                    for labels, v in value.items():
+                        lines.append(f"{name}{self._labels(labels)} {v}")
+                else:
+                    lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    # --- 計測フック ---
+    def instrument_http(self, http):
+        """bot.http.request を包んで route ごとの呼び出し数・所要時間・エラーを数える"""
+        original = http.request
+
+        async def request(route, **kwargs):
+            key = f"{route.method} {route.path}"
+            self.rest_inflight[route.url] = key
+            started = time.perf_counter()
+            try:
+                return await original(route, **kwargs)
+            except discord.HTTPException as e:
+                self.inc("kurisu_rest_errors_total", (("route", key), ("status", e.status)))
+                raise
+            finally:
+                self.observe("kurisu_rest_request_seconds", time.perf_counter() - started)
+                self.inc("kurisu_rest_requests_total", (("route", key),))
+                if self.rest_inflight.get(route.url) == key:
+                    del self.rest_inflight[route.url]
+
+        http.request = request
+        # 429 は discord.py 内部で待って再試行されるので、その警告ログを数える
+        logging.getLogger("discord.http").addHandler(RateLimitCounter(self))
+
+    async def monitor_loop_lag(self, interval: float = 0.5):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            self.observe("kurisu_event_loop_lag_seconds", max(0.0, loop.time() - started - interval))
+
+    async def start(self, host: str, port: int):
+        from aiohttp import web
+
+        async def handle(request):
+            return web.Response(text=self.render(), content_type="text/plain", charset="utf-8",
+                                headers={"X-Content-Type-Options": "nosniff"})
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        self.lag_task = asyncio.create_task(self.monitor_loop_lag())
+        print(f"[INFO] メトリクスを公開しました: http://{host}:{port}/metrics")
+
+    async def close(self):
+        if self.lag_task is not None:
+            self.lag_task.cancel()
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+class RateLimitCounter(logging.Handler):
+    """discord.http の「We are being rate limited」警告を route 別に数える"""
+    def __init__(self, metrics: Metrics):
+        super().__init__(logging.WARNING)
+        self.metrics = metrics
+
+    def emit(self, record: logging.LogRecord):
+        msg = record.msg if isinstance(record.msg, str) else ""
+        if msg.startswith("We are being rate limited") and len(record.args) >= 2:
+            route = self.metrics.rest_inflight.get(record.args[1], "unknown")
+            self.metrics.inc("kurisu_rest_ratelimited_total", (("route", route),))
+        elif msg.startswith("Global rate limit"):
+            self.metrics.inc("kurisu_rest_ratelimited_total", (("route", "global"),))
+
+metrics = Metrics()
+metrics.histogram("kurisu_command_seconds", "スラッシュコマンドの処理時間")
+metrics.counter("kurisu_commands_total", "スラッシュコマンドの実行回数")
+metrics.histogram("kurisu_match_pass_seconds", "マッチング処理1回の所要時間")
+metrics.histogram("kurisu_event_loop_lag_seconds", "イベントループの遅延")
+metrics.counter("kurisu_ledger_commits_total", "pt 台帳への submit の件数（batched: まとめて反映 / waited: ロック待ち）")
+metrics.counter("kurisu_rest_requests_total", "Discord REST 呼び出し回数")
+metrics.counter("kurisu_rest_errors_total", "Discord REST 呼び出しのエラー回数")
+metrics.counter("kurisu_rest_ratelimited_total", "Discord REST の 429 回数")
+metrics.histogram("kurisu_rest_request_seconds", "Discord REST 呼び出しの所要時間（429 の待ちを含む）")
+metrics.gauge("kurisu_waiting_users", "待機中の人数", lambda: len(waiting_list))
+metrics.gauge("kurisu_matching_users", "対戦中の人数", lambda: len(matching))
+metrics.gauge("kurisu_matching_channels", "対戦チャンネルに割り当て中の人数", lambda: len(matching_channels))
+metrics.gauge("kurisu_registered_users", "pt を持つ人数", lambda: len(player_store))
+metrics.gauge("kurisu_rest_queue_depth", "REST キューの待ち件数",
+              lambda: {(("class", name),): st["depth"] for name, st in rest.summary().items()})
+metrics.gauge("kurisu_battle_pool_idle", "待機中の対戦チャンネル数", lambda: len(battle_pool.idle))
+metrics.counter("kurisu_log_dropped_total", "ログ投稿のバッファ溢れで捨てた行数")
+metrics.gauge("kurisu_log_buffered_lines", "ログ投稿の送信待ち行数", lambda: sum(len(buf) for buf in log_sink.buffers.values()))
+metrics.gauge("kurisu_pt_dirty_users", "未保存の pt の人数", lambda: len(pt_store.dirty))
+
+class KurisuTree(app_commands.CommandTree):
+    """コマンドの処理時間を計測する（成功は on_app_command_completion、失敗は on_error で記録）"""
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        interaction.extras["started"] = time.perf_counter()
+        return True
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+        observe_command(interaction, "error")
+        await super().on_error(interaction, error)
+
+def observe_command(interaction: discord.Interaction, status: str):
+    started = interaction.extras.get("started")
+    if started is None or interaction.command is None:
+        return
+    name = interaction.command.qualified_name
+    metrics.observe("kurisu_command_seconds", time.perf_counter() - started, (("command", name),))
+    metrics.inc("kurisu_commands_total", (("command", name), ("status", status)))
+
 # ----------------------------------------
 # ボット初期化
 # ----------------------------------------
 intents = discord.Intents.default()
 intents.guilds = True
 intents.members = True
-bot = commands.Bot(command_prefix="/", intents=intents)
+
+class KurisuBot(commands.Bot):
+    closing = False
+
+    async def setup_hook(self):
+        # pt を先読みしておく（最初の /ランキング から即応答できるように）
+        await asyncio.to_thread(pt_store.open)
+        await asyncio.to_thread(session_store.open)
+        player_store.set_many(await asyncio.to_thread(pt_store.load))
+        rating_engine.import_state(await asyncio.to_thread(pt_store.load_rating_state))
+        self.saved_sessions = await asyncio.to_thread(session_store.load)
+        rank_index.rebuild(player_store.items())
+        print(f"[INFO] pt を読み込みました: {len(player_store)} 人")
+        await asyncio.to_thread(history_log.open, player_store.to_dict())
+        # on_ready は再接続のたびに呼ばれるので、1回だけでよいものはここで始める
+        asyncio.create_task(self.sync_commands())
+        asyncio.create_task(event_scheduler.run(self))
+        print("[INFO] イベントスケジューラーを起動しました")
+        if METRICS_PORT:
+            metrics.instrument_http(self.http)
+            await metrics.start(METRICS_HOST, METRICS_PORT)
+        # 再デプロイは SIGTERM で止めに来る（bot.run は KeyboardInterrupt しか拾わないので、ここで close() に流して書き込みを吐き出す）
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        except NotImplementedError:
+            pass  # Windows
+
+    def command_tree_hash(self, guild) -> str:
+        """登録内容（名前・説明・引数）から作るハッシュ。前回同期時と同じなら sync を省く"""
+        payload = {
+            "scope": COMMAND_SYNC_SCOPE,
+            "guild": guild.id if guild else None,
+            "commands": sorted((cmd.to_dict() for cmd in self.tree.get_commands(guild=guild)), key=lambda c: (c.get("type", 1), c["name"])),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    async def sync_commands(self):
+        guild = None
+        if COMMAND_SYNC_SCOPE != "global":
+            # グローバル定義をギルドにコピーし、グローバル側は空にする（同じコマンドが二重に出ないように）
+            guild = discord.Object(id=GUILD_ID)
+            self.tree.copy_global_to(guild=guild)
+            self.tree.clear_commands(guild=None)
+        digest = self.command_tree_hash(guild)
+        if await asyncio.to_thread(pt_store.get_meta, "command_tree_hash") == digest:
+            print("[INFO] コマンド定義に変更がないため同期を省略しました")
+            return
+        try:
+            if guild is not None:
+                synced = await self.tree.sync(guild=guild)
+                await self.tree.sync()  # 以前のグローバル登録を消す
+            else:
+                synced = await self.tree.sync()
+                await self.tree.sync(guild=discord.Object(id=GUILD_ID))  # 以前のギルド登録を消す
+        except Exception as e:
+            print(f"[ERROR] コマンドの同期に失敗しました: {e}")
+            return
+        await asyncio.to_thread(pt_store.set_meta, "command_tree_hash", digest)
+        print(f"[INFO] コマンドを同期しました: {len(synced)} 件（{COMMAND_SYNC_SCOPE}）")
+
+    async def close(self):
+        if self.closing:
+            return  # SIGTERM 経由で閉じたあと、bot.run の後始末からもう一度呼ばれる
+        self.closing = True
+        await metrics.close()
+        await log_sink.close()
+        await history_log.close()
+        await session_store.close()
+        await pt_store.close()
+        await super().close()
+
+bot = KurisuBot(command_prefix="/", intents=intents, tree_cls=KurisuTree, chunk_guilds_at_startup=not LAZY_MEMBERS)
+
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    observe_command(interaction, "ok")
 
 # ----------------------------------------
 # ユーティリティ
 # ----------------------------------------
+def get_user_pt(user_id: int) -> int:
+    return player_store.get_pt(user_id)
+
+def set_user_pt(user_id: int, pt: int):
+    player_store.set_pt(user_id, pt)
+    pt_store.mark_dirty(user_id)
+    rank_index.set(user_id, pt)
+    ranking_renderer.invalidate()
+    if user_id in match_queue:
+        match_queue.add(user_id, pt)  # 待機中ならランクのバケットを移す
+
+def set_user_pts(updates: dict):
+    """多数の pt をまとめて設定する（ledger のコミット用。ロックを取らないので直接は呼ばない）"""
+    if not updates:
+        return
+    player_store.set_many(updates.items())
+    pt_store.mark_dirty(*updates)
+    if len(updates) * 4 >= len(player_store):
+        rank_index.rebuild(player_store.items())  # 大半が変わるなら作り直した方が速い
+    else:
+        for user_id, pt in updates.items():
+            rank_index.set(user_id, pt)
+    ranking_renderer.invalidate()
+    for user_id in waiting_list:
+        if user_id in updates:
+            match_queue.add(user_id, updates[user_id])
+
 def get_rank_info(pt: int):
-    for start, end, role, icon in rank_roles:
-        if start <= pt <= end:
-            return role, icon
-    return "Unknown", "❓"
+    return rank_info_table.lookup(pt)
 
 def get_internal_rank(pt: int):
-    for rank, rrange in rank_ranges_internal.items():
-        if pt in rrange:
-            return rank
-    return 1
+    return internal_rank_table.lookup(pt)
 
 def calculate_pt(my_pt: int, opp_pt: int, result: str) -> int:
     delta = 1 if result == "win" else -1
     return max(my_pt + delta, 0)
 
-async def update_member_display(member: discord.Member):
-    pt = user_data.get(member.id, {}).get("pt", 0)
-    role_name, icon = get_rank_info(pt)
-    try:
-        await member.edit(nick=f"{member.display_name.split(' ')[0]} {icon} {pt}pt")
+# ----------------------------------------
+# pt 台帳（ユーザー単位のロックとまとめコミット）
+# ----------------------------------------
+LEDGER_STRIPES = 64  # ロックの本数（user_id % LEDGER_STRIPES で割り当てる）
+
+class LedgerTxn:
+    """
+    PtLedger のトランザクション内での読み書き
+    - get() はこのトランザクション（とまとめて処理中の前の依頼）の書き込みを反映した値を返す
+    - set() / log() はコミットまで player_store・history_log に出ない。例外で抜けると捨てられる
+    - 範囲外の pt や履歴に書けない値は set() / log() の時点で ValueError にする（コミットでは失敗しない）
+    """
+    __slots__ = ("user_ids", "base", "writes", "records")
+
+    def __init__(self, user_ids, base=None):
+        self.user_ids = None if user_ids is None else frozenset(user_ids)  # None は全員
+        self.base = base or {}
+        self.writes = {}
+        self.records = []
+
+    def get(self, user_id: int) -> int:
+        if user_id in self.writes:
+            return self.writes[user_id]
+        if user_id in self.base:
+            return self.base[user_id]
+        return get_user_pt(user_id)
+
+    def set(self, user_id: int, pt: int):
+        if self.user_ids is not None and user_id not in self.user_ids:
+            raise ValueError(f"トランザクション外のユーザーです: {user_id}")
+        if not 0 <= pt <= PT_MAX:
+            raise ValueError(f"pt が範囲外です（0〜{PT_MAX}）: {user_id} -> {pt}")
+        self.writes[user_id] = pt
+
+    def log(self, kind: int, user_a: int, user_b: int = 0, pt_a: int = 0, pt_b: int = 0):
+        self.records.append(HistoryLog.pack(kind, user_a, user_b, pt_a, pt_b))
+
+class PtLedger:
+    """
+    pt の読み書き（対戦結果・譲渡・管理者の設定）を、関係するユーザーのロックを取ってから行う
+    - ロックは user_id ごとではなく LEDGER_STRIPES 本に分けて持ち、番号順に取る（デッドロックしない）
+      違うユーザー同士のトランザクションは互いを待たない
+    - transaction(*user_ids): await を挟む処理用。抜けるときに書き込みと履歴をまとめて反映する
+    - submit(user_ids, fn): 同期の fn(txn) を次のループ周回でまとめて実行し、同じ周回に来た依頼
+      （同時に確定した複数の試合など）の pt 反映・インデックス更新・履歴追記を1回で行う
+      ロックが使用中のユーザーを含む依頼だけ、空くのを待ってから個別に実行する
+    """
+    def __init__(self, stripes: int = LEDGER_STRIPES):
+        self.stripes = stripes
+        self.locks = [asyncio.Lock() for _ in range(stripes)]
+        self.busy = [0] * stripes  # ストライプごとの「保持中＋待ち」の数
+        self.queue = []
+        self.scheduled = False
+
+    def _stripes(self, user_ids):
+        if user_ids is None:
+            return list(range(self.stripes))
+        return sorted({uid % self.stripes for uid in user_ids})
+
+    def transaction(self, *user_ids):
+        return self._transaction(user_ids)
+
+    def transaction_all(self):
+        """全員分のロックを取る（全体リセット・履歴からの再計算用）"""
+        return self._transaction(None)
+
+    @contextlib.asynccontextmanager
+    async def _transaction(self, user_ids):
+        stripes = self._stripes(user_ids)
+        for s in stripes:
+            self.busy[s] += 1
+        acquired = []
+        try:
+            for s in stripes:
+                await self.locks[s].acquire()
+                acquired.append(s)
+            txn = LedgerTxn(user_ids)
+            yield txn
+            self._commit(txn.writes, txn.records)
+        finally:
+            for s in reversed(acquired):
+                self.locks[s].release()
+            for s in stripes:
+                self.busy[s] -= 1
+
+    def submit(self, user_ids, fn) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.append((tuple(user_ids), fn, future))
+        if not self.scheduled:
+            self.scheduled = True
+            loop.call_soon(self._run_batch)
+        return future
+
+    def _run_batch(self):
+        self.scheduled = False
+        batch, self.queue = self.queue, []
+        writes = {}
+        records = []
+        done = []
+        for user_ids, fn, future in batch:
+            if future.cancelled():
+                continue
+            if any(self.busy[s] for s in self._stripes(user_ids)):
+                metrics.inc("kurisu_ledger_commits_total", (("path", "waited"),))
+                asyncio.create_task(self._run_locked(user_ids, fn, future))
+                continue
+            # ロックが空いていて fn も同期なので、この場で実行しても他の処理は割り込めない
+            txn = LedgerTxn(user_ids, writes)
+            try:
+                result = fn(txn)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            writes.update(txn.writes)
+            records.extend(txn.records)
+            done.append((future, result))
+        self._commit(writes, records)
+        # 結果を受け取る側は、コミット後に再開する
+        for future, result in done:
+            future.set_result(result)
+        if done:
+            metrics.inc("kurisu_ledger_commits_total", (("path", "batched"),), len(done))
+
+    async def _run_locked(self, user_ids, fn, future):
+        try:
+            async with self.transaction(*user_ids) as txn:
+                result = fn(txn)
+        except Exception as e:
+            if not future.cancelled():
+                future.set_exception(e)
+            return
+        if not future.cancelled():
+            future.set_result(result)
+
+    def _commit(self, writes: dict, records: list):
+        # records は log() の時点で pack 済みなので、ここから先は失敗しない
+        data = b"".join(records)
+        set_user_pts(writes)
+        history_log.append_packed(data)
+
+ledger = PtLedger()
+
+# ----------------------------------------
+# レーティング計算
+# ----------------------------------------
+def match_waves(winners, losers):
+    """
+    時系列順の対戦を「同じ人が2回出てこない」グループに分ける
+    各グループ内は互いに独立なので、グループ単位でまとめて（ベクトル化して）計算できる
+    """
+    last = {}
+    waves = np.empty(len(winners), dtype=np.int64)
+    for i, (w, l) in enumerate(zip(winners.tolist(), losers.tolist())):
+        wave = max(last.get(w, -1), last.get(l, -1)) + 1
+        last[w] = last[l] = wave
+        waves[i] = wave
+    order = np.argsort(waves, kind="stable")
+    bounds = np.flatnonzero(np.diff(waves[order])) + 1
+    return np.split(order, bounds)
+
+class RatingEngine:
+    """
+    対戦結果から新しい pt を計算する
+    - rate(): 1試合分（ライブ用）
+    - batch(): 全履歴を全員 0pt から再計算（numpy が必要）
+    - export_state() / import_state(): pt 以外の内部状態を pt_store に保存・起動時に復元する
+    """
+    name = ""
+
+    def rate(self, winner_id: int, loser_id: int, winner_pt: int, loser_pt: int):
+        raise NotImplementedError
+
+    def export_state(self, user_ids) -> list:
+        """保存する内部状態 [(user_id, mu, phi, sigma)]（pt だけで決まる方式は空）"""
+        return []
+
+    def import_state(self, rows):
+        pass
+
+    def batch(self, winners, losers, n_players: int):
+        """winners/losers は選手 index の配列。最終 pt の配列を返す"""
+        if np is None:
+            raise RuntimeError("numpy がインストールされていません")
+        state = self.batch_init(n_players)
+        for idx in match_waves(winners, losers):
+            self.batch_apply(state, winners[idx], losers[idx])
+        return self.batch_result(state)
+
+    def batch_init(self, n_players: int):
+        return np.zeros(n_players, dtype=np.int64)
+
+    def batch_apply(self, state, w, l):
+        raise NotImplementedError
+
+    def batch_result(self, state):
+        return state
+
+class PlusMinusOneEngine(RatingEngine):
+    """現行ルール：勝ち +1 / 負け -1（0 未満にはならない）"""
+    name = "plusminus"
+
+    def rate(self, winner_id, loser_id, winner_pt, loser_pt):
+        return calculate_pt(winner_pt, loser_pt, "win"), calculate_pt(loser_pt, winner_pt, "lose")
+
+    def batch_apply(self, pts, w, l):
+        pts[w] += 1
+        pts[l] = np.maximum(pts[l] - 1, 0)
+
+class EloEngine(RatingEngine):
+    """
+    pt をそのままレーティングとして扱う Elo
+    scale pt 差で期待勝率が 10 倍、同 pt 同士なら ±k/2（既定 ±1）
+    """
+    name = "elo"
+
+    def __init__(self, k: float = 2.0, scale: float = 10.0):
+        self.k = k
+        self.scale = scale
+
+    def rate(self, winner_id, loser_id, winner_pt, loser_pt):
+        expected = 1 / (1 + 10 ** ((loser_pt - winner_pt) / self.scale))
+        delta = round(self.k * (1 - expected))
+        return max(winner_pt + delta, 0), max(loser_pt - delta, 0)
+
+    def batch_apply(self, pts, w, l):
+        expected = 1 / (1 + 10.0 ** ((pts[l] - pts[w]) / self.scale))
+        delta = np.rint(self.k * (1 - expected)).astype(np.int64)
+        pts[w] = np.maximum(pts[w] + delta, 0)
+        pts[l] = np.maximum(pts[l] - delta, 0)
+
+class Glicko2Engine(RatingEngine):
+    """
+    Glicko-2（1試合ごとに1レーティング期間として更新）
+    内部値 mu = pt / unit として扱い、RD と volatility は pt と一緒に pt_store（rating_state）へ保存する
+    （再起動のたびに RD が初期値に戻ると、直後の1試合だけ pt が大きく動いてしまう）
+    """
+    name = "glicko2"
+    SCALE = 173.7178
+
+    def __init__(self, unit: float = 4.0, tau: float = 0.5, rd: float = 350.0, sigma: float = 0.06):
+        self.unit = unit
+        self.tau = tau
+        self.phi0 = rd / self.SCALE
+        self.sigma0 = sigma
+        self.state = {}  # user_id -> [mu, phi, sigma]
+
+    def export_state(self, user_ids):
+        return [(uid, *self.state[uid]) for uid in user_ids if uid in self.state]
+
+    def import_state(self, rows):
+        for uid, mu, phi, sigma in rows:
+            self.state[uid] = [mu, phi, sigma]
+
+    def _player(self, user_id: int, pt: int):
+        st = self.state.get(user_id)
+        if st is None or max(round(st[0] * self.unit), 0) != pt:
+            # 初登場か、管理コマンドなどで pt が外から変わった場合は pt に合わせ直す
+            st = [pt / self.unit, st[1] if st else self.phi0, st[2] if st else self.sigma0]
+            self.state[user_id] = st
+        return st
+
+    def _volatility(self, phi, sigma, v, delta):
+        a = math.log(sigma ** 2)
+        tau2 = self.tau ** 2
+        def f(x):
+            ex = math.exp(x)
+            return ex * (delta ** 2 - phi ** 2 - v - ex) / (2 * (phi ** 2 + v + ex) ** 2) - (x - a) / tau2
+        A = a
+        if delta ** 2 > phi ** 2 + v:
+            B = math.log(delta ** 2 - phi ** 2 - v)
+        else:
+            k = 1
+            while f(a - k * self.tau) < 0:
+                k += 1
+            B = a - k * self.tau
+        fA, fB = f(A), f(B)
+        while abs(B - A) > 1e-6:
+            C = A + (A - B) * fA / (fB - fA)
+            fC = f(C)
+            if fC * fB <= 0:
+                A, fA = B, fB
+            else:
+                fA /= 2
+            B, fB = C, fC
+        return math.exp(A / 2)
+
+    def _update(self, me, opp, score):
+        mu, phi, sigma = me
+        g = 1 / math.sqrt(1 + 3 * opp[1] ** 2 / math.pi ** 2)
+        e = 1 / (1 + math.exp(-g * (mu - opp[0])))
+        v = 1 / (g ** 2 * e * (1 - e))
+        delta = v * g * (score - e)
+        sigma_new = self._volatility(phi, sigma, v, delta)
+        phi_star = math.sqrt(phi ** 2 + sigma_new ** 2)
+        phi_new = 1 / math.sqrt(1 / phi_star ** 2 + 1 / v)
+        return [mu + phi_new ** 2 * g * (score - e), phi_new, sigma_new]
+
+    def rate(self, winner_id, loser_id, winner_pt, loser_pt):
+        w = self._player(winner_id, winner_pt)
+        l = self._player(loser_id, loser_pt)
+        w_new, l_new = self._update(w, l, 1.0), self._update(l, w, 0.0)
+        self.state[winner_id] = w_new
+        self.state[loser_id] = l_new
+        return max(round(w_new[0] * self.unit), 0), max(round(l_new[0] * self.unit), 0)
+
+    def batch_init(self, n_players):
+        return {
+            "mu": np.zeros(n_players),
+            "phi": np.full(n_players, self.phi0),
+            "sigma": np.full(n_players, self.sigma0),
+        }
+
+    def _batch_volatility(self, phi, sigma, v, delta):
+        a = np.log(sigma ** 2)
+        tau2 = self.tau ** 2
+        def f(x):
+            ex = np.exp(x)
+            return ex * (delta ** 2 - phi ** 2 - v - ex) / (2 * (phi ** 2 + v + ex) ** 2) - (x - a) / tau2
+        A = a.copy()
+        big = delta ** 2 > phi ** 2 + v
+        B = np.where(big, np.log(np.where(big, delta ** 2 - phi ** 2 - v, 1.0)), a - self.tau)
+        k = np.ones_like(a)
+        todo = ~big & (f(B) < 0)
+        while todo.any():
+            k[todo] += 1
+            B[todo] = a[todo] - k[todo] * self.tau
+            todo &= f(B) < 0
+        fA, fB = f(A), f(B)
+        active = np.abs(B - A) > 1e-6
+        while active.any():
+            C = A + (A - B) * fA / (fB - fA)
+            fC = f(C)
+            swap = fC * fB <= 0
+            A = np.where(active & swap, B, A)
+            fA = np.where(active & swap, fB, np.where(active, fA / 2, fA))
+            B = np.where(active, C, B)
+            fB = np.where(active, fC, fB)
+            active &= np.abs(B - A) > 1e-6
+        return np.exp(A / 2)
+
+    def _batch_update(self, mu, phi, sigma, mu_o, phi_o, score):
+        g = 1 / np.sqrt(1 + 3 * phi_o ** 2 / math.pi ** 2)
+        e = 1 / (1 + np.exp(-g * (mu - mu_o)))
+        v = 1 / (g ** 2 * e * (1 - e))
+        delta = v * g * (score - e)
+        sigma_new = self._batch_volatility(phi, sigma, v, delta)
+        phi_star = np.sqrt(phi ** 2 + sigma_new ** 2)
+        phi_new = 1 / np.sqrt(1 / phi_star ** 2 + 1 / v)
+        return mu + phi_new ** 2 * g * (score - e), phi_new, sigma_new
+
+    def batch_apply(self, st, w, l):
+        mu, phi, sigma = st["mu"], st["phi"], st["sigma"]
+        w_new = self._batch_update(mu[w], phi[w], sigma[w], mu[l], phi[l], 1.0)
+        l_new = self._batch_update(mu[l], phi[l], sigma[l], mu[w], phi[w], 0.0)
+        mu[w], phi[w], sigma[w] = w_new
+        mu[l], phi[l], sigma[l] = l_new
+
+    def batch_result(self, st):
+        return np.maximum(np.rint(st["mu"] * self.unit), 0).astype(np.int64)
+
+RATING_ENGINES = {
+    PlusMinusOneEngine.name: PlusMinusOneEngine,
+    EloEngine.name: EloEngine,
+    Glicko2Engine.name: Glicko2Engine,
+}
+rating_engine = RATING_ENGINES.get(RATING_ENGINE, PlusMinusOneEngine)()
+
+# ----------------------------------------
+# REST 呼び出しの優先度付きスケジューラー
+# ----------------------------------------
+PRIORITY_INTERACTION = 0  # 対戦開始まわり（チャンネル貸し出し・開始メッセージ・待機メッセージ更新）・ボタン操作後のメッセージ更新
+PRIORITY_DISPLAY = 1      # ニックネーム・ロール更新
+PRIORITY_BACKGROUND = 2   # ログ投稿・チャンネル片付け・イベント通知と公開切替
+
+class RestScheduler:
+    """
+    Discord への REST 呼び出しを優先度順に流す
+    - 呼び出しは route ごとの待ち行列に入れ、route の同時実行数が route_limit 未満のものだけを実行候補にする
+    - 全体の空き（concurrency）ができたら、候補の中で一番優先度の高い（数字の小さい）呼び出しを実行
+      （混んでいる route の待ちが全体の枠を占有して、他の route を止めることはない）
+    - interaction への直接の応答（interaction.response）は 3 秒制限があるのでここを通さず即時に送る
+    - 意図的に通さないもの:
+      - interaction.followup.send（コマンドへの返信そのもの。response と同じ扱い）
+      - iter_members の guild.fetch_members（ページ送りの反復なので1回の呼び出しに包めない。LAZY_MEMBERS 時の一括処理のみ）
+    """
+    CLASS_NAMES = {
+        PRIORITY_INTERACTION: "interaction",
+        PRIORITY_DISPLAY: "display",
+        PRIORITY_BACKGROUND: "background",
+    }
+
+    def __init__(self, concurrency: int, route_limit: int):
+        self.concurrency = concurrency
+        self.route_limit = route_limit
+        self.seq = itertools.count()
+        self.routes = {}        # route -> 待ち行列（(priority, seq, func, fut, queued_at) の heap）
+        self.route_active = {}  # route -> 実行中の数
+        self.ready = []         # 空きのある route の先頭 (priority, seq, route) の heap（古いものは取り出し時に捨てる）
+        self.running = 0
+        self.stats = {p: {"depth": 0, "done": 0, "failed": 0, "wait_total": 0.0, "wait_max": 0.0} for p in self.CLASS_NAMES}
+
+    async def call(self, priority: int, route: str, func):
+        """func() が返すコルーチンを順番が来たら実行し、その結果を返す（例外もそのまま投げる）"""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.stats[priority]["depth"] += 1
+        seq = next(self.seq)
+        heapq.heappush(self.routes.setdefault(route, []), (priority, seq, func, fut, loop.time()))
+        if self.route_active.get(route, 0) < self.route_limit:
+            heapq.heappush(self.ready, (priority, seq, route))
+        self._dispatch()
+        return await fut
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while self.running < self.concurrency and self.ready:
+            _, seq, route = heapq.heappop(self.ready)
+            pending = self.routes.get(route)
+            if not pending or pending[0][1] != seq or self.route_active.get(route, 0) >= self.route_limit:
+                continue  # 先頭が入れ替わったか、route が埋まっている
+            priority, _, func, fut, queued_at = heapq.heappop(pending)
+            st = self.stats[priority]
+            st["depth"] -= 1
+            wait = loop.time() - queued_at
+            st["wait_total"] += wait
+            st["wait_max"] = max(st["wait_max"], wait)
+            self.running += 1
+            self.route_active[route] = self.route_active.get(route, 0) + 1
+            self._push_head(route)
+            asyncio.create_task(self._run(priority, route, func, fut))
+
+    def _push_head(self, route: str):
+        pending = self.routes.get(route)
+        if not pending:
+            self.routes.pop(route, None)
+        elif self.route_active.get(route, 0) < self.route_limit:
+            heapq.heappush(self.ready, (pending[0][0], pending[0][1], route))
+
+    async def _run(self, priority: int, route: str, func, fut: asyncio.Future):
+        try:
+            if fut.cancelled():
+                return
+            try:
+                result = await func()
+            except Exception as e:
+                self.stats[priority]["failed"] += 1
+                if not fut.cancelled():
+                    fut.set_exception(e)
+                return
+            self.stats[priority]["done"] += 1
+            if not fut.cancelled():
+                fut.set_result(result)
+        finally:
+            self.running -= 1
+            self.route_active[route] -= 1
+            if not self.route_active[route]:
+                del self.route_active[route]
+            self._push_head(route)
+            self._dispatch()
+
+    def summary(self) -> dict:
+        result = {}
+        for p, st in self.stats.items():
+            finished = st["done"] + st["failed"]
+            result[self.CLASS_NAMES[p]] = {
+                "depth": st["depth"],
+                "done": st["done"],
+                "failed": st["failed"],
+                "wait_avg": st["wait_total"] / finished if finished else 0.0,
+                "wait_max": st["wait_max"],
+            }
+        return result
+
+rest = RestScheduler(REST_CONCURRENCY, REST_ROUTE_CONCURRENCY)
+
+# ----------------------------------------
+# メンバーキャッシュ（LAZY_MEMBERS 用）
+# ----------------------------------------
+class MemberCache:
+    """
+    起動時にメンバー一覧を取らない場合に、guild.get_member で見つからないメンバーを補う LRU
+    - get(): discord.py のキャッシュ → LRU の順に探し、無ければ裏で fetch_member して今回は None を返す
+    - fetch(): 無ければその場で fetch_member して待つ（同じ人の取得は1本にまとめる）
+    - LAZY_MEMBERS でなければ guild.get_member と同じ
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self.members = OrderedDict()  # user_id -> Member（古い順）
+        self.pending = {}             # user_id -> 取得中の Task
+
+    def get(self, guild: discord.Guild, user_id: int, fill: bool = True):
+        member = guild.get_member(user_id)
+        if member is not None:
+            return member
+        member = self.members.get(user_id)
+        if member is not None:
+            self.members.move_to_end(user_id)
+            return member
+        if fill and LAZY_MEMBERS:
+            self.fill(guild, user_id)
+        return None
+
+    async def fetch(self, guild: discord.Guild, user_id: int):
+        member = self.get(guild, user_id, fill=False)
+        if member is not None or not LAZY_MEMBERS:
+            return member
+        return await self.fill(guild, user_id)
+
+    def fill(self, guild: discord.Guild, user_id: int) -> asyncio.Task:
+        task = self.pending.get(user_id)
+        if task is None:
+            task = self.pending[user_id] = asyncio.create_task(self._fetch(guild, user_id))
+        return task
+
+    async def _fetch(self, guild: discord.Guild, user_id: int):
+        try:
+            member = await rest.call(PRIORITY_DISPLAY, "member_fetch", lambda: guild.fetch_member(user_id))
+        except discord.NotFound:
+            member = None
+        except Exception as e:
+            print(f"[ERROR] メンバー {user_id} の取得に失敗しました: {e}")
+            member = None
+        finally:
+            self.pending.pop(user_id, None)
+        if member is not None:
+            self.put(member)
+        return member
+
+    def put(self, member: discord.Member):
+        self.members[member.id] = member
+        self.members.move_to_end(member.id)
+        while len(self.members) > self.size:
+            self.members.popitem(last=False)
+
+    def refresh(self, member: discord.Member):
+        """保持しているメンバーだけ新しいオブジェクトに差し替える"""
+        if member.id in self.members:
+            self.members[member.id] = member
+
+    def discard(self, user_id: int):
+        self.members.pop(user_id, None)
+
+member_cache = MemberCache(MEMBER_CACHE_SIZE)
+
+def get_member(guild: discord.Guild, user_id: int):
+    return member_cache.get(guild, user_id)
+
+def member_or_object(guild: discord.Guild, user_id: int):
+    """権限上書きのキー用。メンバーが手元に無くても ID だけで指定できる"""
+    return member_cache.get(guild, user_id) or discord.Object(id=user_id)
+
+async def iter_members(guild: discord.Guild):
+    """
+    全メンバーを少しずつ返す
+    - LAZY_MEMBERS なら REST で 1000 人ずつ取得しながら返す
+    - そうでなければキャッシュから返す（1000 人ごとにイベントループへ制御を返す）
+    """
+    if LAZY_MEMBERS:
+        async for member in guild.fetch_members(limit=None):
+            yield member
+        return
+    for i, member in enumerate(list(guild.members), 1):
+        yield member
+        if i % 1000 == 0:
+            await asyncio.sleep(0)
+
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    member_cache.refresh(after)
+    # ロール付け替えや pt 表示だけの変更ではページを作り直さない（pt の変更は set_user_pt 側で作り直す）
+    if RankingRenderer.base_name(before.display_name) != RankingRenderer.base_name(after.display_name):
+        ranking_renderer.member_changed(after.id)
+
+@bot.event
+async def on_raw_member_remove(payload: discord.RawMemberRemoveEvent):
+    member_cache.discard(payload.user.id)
+    ranking_renderer.member_changed(payload.user.id)
+
+# ----------------------------------------
+# ギルドオブジェクトのキャッシュ
+# ----------------------------------------
+class GuildCache:
+    """
+    ランクロールと固定チャンネル（ログ・審議・マッチング・お知らせ・対戦カテゴリ）のオブジェクトを覚えておく
+    - ロールは名前で一度だけ guild.roles から探す（ランクロールの ID 集合もまとめて持つ）
+    - チャンネルは ID で一度だけ bot.get_channel する
+    - on_guild_role_* / on_guild_channel_* イベントで該当分を捨てる
+    """
+    def __init__(self):
+        self.roles = {}          # ロール名 -> Role
+        self.rank_role_ids = None
+        self.channels = {}       # channel_id -> チャンネル
+
+    def role(self, guild: discord.Guild, name: str):
+        role = self.roles.get(name)
+        if role is None:
+            role = discord.utils.get(guild.roles, name=name)
+            if role is not None:
+                self.roles[name] = role
+        return role
+
+    def rank_roles_ids(self, guild: discord.Guild) -> set:
+        if self.rank_role_ids is None:
+            self.rank_role_ids = {role.id for role in (self.role(guild, r[2]) for r in rank_roles) if role}
+        return self.rank_role_ids
+
+    def channel(self, channel_id: int):
+        ch = self.channels.get(channel_id)
+        if ch is None:
+            ch = bot.get_channel(channel_id)
+            if ch is not None:
+                self.channels[channel_id] = ch
+        return ch
+
+    def invalidate_role(self, role: discord.Role):
+        # 名前が変わった場合もあるので ID と名前の両方で消す
+        self.roles = {name: r for name, r in self.roles.items() if r.id != role.id and name != role.name}
+        self.rank_role_ids = None
+
+    def invalidate_channel(self, channel):
+        self.channels.pop(channel.id, None)
+
+guild_cache = GuildCache()
+
+@bot.event
+async def on_guild_role_create(role: discord.Role):
+    guild_cache.invalidate_role(role)
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    guild_cache.invalidate_role(before)
+    guild_cache.invalidate_role(after)
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    guild_cache.invalidate_role(role)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    guild_cache.invalidate_channel(after)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    guild_cache.invalidate_channel(channel)
+
+# ----------------------------------------
+# 表示同期（ニックネーム・ランクロール）
+# ----------------------------------------
+class DisplaySync:
+    """
+    メンバーのニックネームとランクロールを pt に合わせる
+    - 目標の nick / ロールを計算し、変化がなければ何もしない
+    - 変化があれば member.edit(nick=..., roles=...) 1回で反映
+    - schedule() は window 秒の間の更新をまとめ、最後の pt だけを書き込む
+    """
+    def __init__(self, window: float):
+        self.window = window
+        self.pending = {}   # member_id -> 最新の Member
+
+    def target_changes(self, member: discord.Member) -> dict:
+        """member.edit に渡す差分（変化なしなら空）"""
+        pt = get_user_pt(member.id)
+        role_name, icon = get_rank_info(pt)
+        changes = {}
+        nick = f"{member.display_name.split(' ')[0]} {icon} {pt}pt"
+        if member.display_name != nick:
+            changes["nick"] = nick
+
         guild = member.guild
-        for r in rank_roles:
-            role = discord.utils.get(guild.roles, name=r[2])
-            if role and role in member.roles:
-                await member.remove_roles(role)
-        new_role = discord.utils.get(guild.roles, name=role_name)
+        rank_role_ids = guild_cache.rank_roles_ids(guild)
+        new_role = guild_cache.role(guild, role_name)
+        current = [r for r in member.roles if not r.is_default()]
+        roles = [r for r in current if r.id not in rank_role_ids]
         if new_role:
-            await member.add_roles(new_role)
-    except Exception as e:
-        print(f"Error updating {member}: {e}")
+            roles.append(new_role)
+        if {r.id for r in roles} != {r.id for r in current}:
+            changes["roles"] = roles
+        return changes
+
+    async def apply(self, member: discord.Member) -> bool:
+        """差分があれば反映して True を返す"""
+        changes = self.target_changes(member)
+        if not changes:
+            return False
+        try:
+            updated = await rest.call(PRIORITY_DISPLAY, "member_edit", lambda: member.edit(**changes))
+        except Exception as e:
+            print(f"Error updating {member}: {e}")
+            return False
+        if updated is not None:
+            member_cache.refresh(updated)
+        return True
+
+    def schedule(self, member: discord.Member):
+        first = member.id not in self.pending
+        self.pending[member.id] = member
+        if first:
+            asyncio.create_task(self._apply_later(member.id))
+
+    async def _apply_later(self, member_id: int):
+        await asyncio.sleep(self.window)
+        member = self.pending.pop(member_id, None)
+        if member:
+            await self.apply(member)
+
+display_sync = DisplaySync(DISPLAY_SYNC_SECONDS)
+
+def update_member_display(member: discord.Member):
+    display_sync.schedule(member)
+
+def update_member_display_by_id(guild: discord.Guild, user_id: int):
+    """メンバーが手元に無ければ取得してから表示を更新する"""
+    member = member_cache.get(guild, user_id, fill=False)
+    if member is not None:
+        update_member_display(member)
+    elif LAZY_MEMBERS:
+        asyncio.create_task(_update_member_display_after_fetch(guild, user_id))
+
+async def _update_member_display_after_fetch(guild: discord.Guild, user_id: int):
+    member = await member_cache.fetch(guild, user_id)
+    if member is not None:
+        update_member_display(member)
+
+# ----------------------------------------
+# 一括表示更新（全体リセット用）
+# ----------------------------------------
+class BulkDisplayUpdater:
+    """
+    多数のメンバーの表示を同時実行数を絞って更新する
+    - 渡されたメンバーのうち表示に変化があるものだけ member.edit する
+    - 429 を受けたら Retry-After の間は全ワーカーを止めてから再試行する
+    """
+    MAX_RETRIES = 3
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.total = 0
+        self.done = 0
+        self.updated = 0
+        self.failed = 0
+        self.pause_until = 0.0
+
+    async def run(self, members):
+        """members はリストでも async iterator でもよい（取得しながら流し込む）"""
+        queue = asyncio.Queue(maxsize=self.workers * 4)
+
+        async def produce():
+            try:
+                if hasattr(members, "__aiter__"):
+                    async for member in members:
+                        self.total += 1
+                        await queue.put(member)
+                else:
+                    for member in members:
+                        self.total += 1
+                        await queue.put(member)
+            finally:
+                for _ in range(self.workers):
+                    await queue.put(None)
+
+        await asyncio.gather(produce(), *(self._worker(queue) for _ in range(self.workers)))
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            member = await queue.get()
+            if member is None:
+                return
+            changes = display_sync.target_changes(member)
+            if changes:
+                if await self._edit(member, changes):
+                    self.updated += 1
+                else:
+                    self.failed += 1
+            self.done += 1
+
+    async def _edit(self, member: discord.Member, changes: dict) -> bool:
+        loop = asyncio.get_running_loop()
+        for _ in range(self.MAX_RETRIES):
+            wait = self.pause_until - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                await rest.call(PRIORITY_DISPLAY, "member_edit", lambda: member.edit(**changes))
+                return True
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    print(f"Error updating {member}: {e}")
+                    return False
+                retry_after = float(e.response.headers.get("Retry-After", 1)) if e.response is not None else 1.0
+                self.pause_until = max(self.pause_until, loop.time() + retry_after)
+            except Exception as e:
+                print(f"Error updating {member}: {e}")
+                return False
+        print(f"Error updating {member}: rate limited")
+        return False
 
 def is_registered_match(a: int, b: int):
     return matching.get(a) == b and matching.get(b) == a
 
+# ----------------------------------------
+# 期限キュー（待機タイムアウトなどを1本のタスクで管理）
+# ----------------------------------------
+class DeadlineQueue:
+    """
+    key ごとの期限を管理し、期限が来たら callback(key) を呼ぶ
+    - heapq + 世代番号による遅延削除で 追加/取消/延長 は O(log n)
+    - extend_all() は全員の期限の下限を上げるだけ（O(1)）。下限より早く取り出されたものは下限で積み直す
+    - 期限は loop.time() 基準
+    """
+    def __init__(self, callback):
+        self.callback = callback  # async def callback(key)
+        self.heap = []            # (deadline, seq, key)
+        self.entries = {}         # key -> (deadline, seq) 現在有効なもの
+        self.floor = 0.0
+        self.seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def schedule(self, key, deadline: float):
+        """追加・延長（既存の期限は置き換え）"""
+        seq = next(self.seq)
+        self.entries[key] = (deadline, seq)
+        heapq.heappush(self.heap, (deadline, seq, key))
+        if self.heap[0][1] == seq:
+            self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def cancel(self, key) -> bool:
+        return self.entries.pop(key, None) is not None
+
+    def extend_all(self, deadline: float):
+        """全員の期限を少なくとも deadline まで延ばす"""
+        self.floor = max(self.floor, deadline)
+
+    def _is_stale(self, seq, key):
+        entry = self.entries.get(key)
+        return entry is None or entry[1] != seq
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while self.heap and self._is_stale(self.heap[0][1], self.heap[0][2]):
+                heapq.heappop(self.heap)
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+            deadline, seq, key = self.heap[0]
+            remaining = deadline - loop.time()
+            if remaining > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.heap)
+            if deadline < self.floor:
+                # 全員延長の後なので下限で積み直す
+                self.entries[key] = (self.floor, seq)
+                heapq.heappush(self.heap, (self.floor, seq, key))
+                continue
+            del self.entries[key]
+            asyncio.create_task(self._fire(key))
+
+    async def _fire(self, key):
+        try:
+            await self.callback(key)
+        except Exception as e:
+            print(f"[ERROR] 期限処理に失敗しました ({key}): {e}")
+
+# ----------------------------------------
+# マッチングキュー（内部ランク別バケット）
+# ----------------------------------------
+class MatchQueue:
+    """
+    待機ユーザーを内部ランク（rank_ranges_internal）ごとのバケットで管理する
+    - 追加/削除は O(1)（バケット内は末尾と入れ替えて pop）
+    - 対戦相手の探索はランク差 < MAX_RANK_GAP のバケットだけを見る
+    - 候補全体から一様ランダムに選ぶのでバケット内の公平性は維持される
+    """
+    MAX_RANK_GAP = 3
+
+    def __init__(self):
+        self.buckets = {rank: [] for rank in rank_ranges_internal}
+        self.pos = {}  # user_id -> (rank, バケット内 index)
+        self.recent_joins = dict.fromkeys(rank_ranges_internal, 0.0)  # ランクごとの最近の参加数（PAIR_JOIN_DECAY で減衰）
+
+    def __len__(self):
+        return len(self.pos)
+
+    def __contains__(self, user_id: int):
+        return user_id in self.pos
+
+    def add(self, user_id: int, pt: int):
+        rank = get_internal_rank(pt)
+        if user_id in self.pos:
+            self.remove(user_id)
+        else:
+            for r in self.recent_joins:
+                self.recent_joins[r] *= PAIR_JOIN_DECAY
+            self.recent_joins[rank] += 1.0
+        self._push(user_id, rank)
+
+    def remove(self, user_id: int) -> bool:
+        entry = self.pos.pop(user_id, None)
+        if entry is None:
+            return False
+        rank, idx = entry
+        bucket = self.buckets[rank]
+        last = bucket.pop()
+        if last != user_id:
+            bucket[idx] = last
+            self.pos[last] = (rank, idx)
+        return True
+
+    def _eligible_ranks(self, rank: int):
+        return [r for r in self.buckets if abs(r - rank) < self.MAX_RANK_GAP]
+
+    def find_opponent(self, user_id: int):
+        """user_id と対戦可能な待機ユーザーを一様ランダムに1人返す（いなければ None）"""
+        entry = self.pos.get(user_id)
+        if entry is None:
+            return None
+        rank = entry[0]
+        ranks = self._eligible_ranks(rank)
+        total = sum(len(self.buckets[r]) for r in ranks) - 1  # 自分を除く
+        if total <= 0:
+            return None
+        k = random.randrange(total)
+        for r in ranks:
+            bucket = self.buckets[r]
+            size = len(bucket) - (1 if r == rank else 0)
+            if k < size:
+                if r == rank and k >= entry[1]:
+                    k += 1  # 自分の位置を飛ばす
+                return bucket[k]
+            k -= size
+        return None
+
+    def _random_member(self):
+        k = random.randrange(len(self.pos))
+        for bucket in self.buckets.values():
+            if k < len(bucket):
+                return bucket[k]
+            k -= len(bucket)
+        return None
+
+    def take_pairs(self):
+        """
+        対戦可能なペアをまとめて取り出す
+        ランダムに1人選び、残りから相手を探す。相手がいない人は今回は見送り、最後に戻す
+        """
+        pairs = []
+        skipped = []
+        while self.pos:
+            u1 = self._random_member()
+            u2 = self.find_opponent(u1)
+            rank = self.pos[u1][0]
+            self.remove(u1)
+            if u2 is None:
+                skipped.append((u1, rank))
+                continue
+            self.remove(u2)
+            pairs.append((u1, u2))
+        for uid, rank in skipped:
+            self._push(uid, rank)
+        return pairs
+
+    def take_pairs_batch(self, waited: dict):
+        """
+        待機者全体を batch_pairs() で一度に組み合わせて取り出す（MATCH_MODE=batch）
+        waited: user_id -> 待ち秒数
+        """
+        players = [(uid, rank, waited.get(uid, 0.0)) for uid, (rank, _) in self.pos.items()]
+        pairs = batch_pairs(players, self.MAX_RANK_GAP, self.compatible_share())
+        for u1, u2 in pairs:
+            self.remove(u1)
+            self.remove(u2)
+        return pairs
+
+    def compatible_share(self) -> dict:
+        """ランク -> 最近の参加者のうち対戦可能なランクの人の割合（少ないほど次の相手が来にくい）"""
+        total = sum(self.recent_joins.values())
+        if total <= 0:
+            return dict.fromkeys(self.buckets, 1.0)
+        return {rank: sum(self.recent_joins[r] for r in self._eligible_ranks(rank)) / total for rank in self.buckets}
+
+    def _push(self, user_id: int, rank: int):
+        bucket = self.buckets[rank]
+        self.pos[user_id] = (rank, len(bucket))
+        bucket.append(user_id)
+
+match_queue = MatchQueue()
+
+# ----------------------------------------
+# 一括マッチング（最小コストの組み合わせ）
+# ----------------------------------------
+PAIR_GAP_COST = 1.0    # ランク差1あたりのコスト
+PAIR_SKIP_COST = 2.5   # 1人を今回見送るコスト（2人とも見送るより、ランク差最大でも組む方が安くなる値）
+PAIR_WAIT_COST = 10.0  # 見送りコストに待ち時間（WAITING_SECONDS で割った値）に比例して足す分
+PAIR_SCARCITY_COST = float(os.environ.get("PAIR_SCARCITY_COST", "4.0"))  # 見送りコストに「対戦可能な相手の来にくさ」（1 - 割合）に比例して足す分
+PAIR_JOIN_DECAY = 0.99  # ランクごとの参加数を数えるときの減衰（1人参加するごとに掛ける）
+PAIR_EXACT_MAX = 12    # この人数以下なら全探索で厳密解を出す
+PAIR_WINDOW = 4        # 並べ替え後の DP で相手として見る直前の人数
+
+def pair_skip_cost(rank: int, waited: float, share: dict = None) -> float:
+    """1人を今回見送るコスト（長く待っている人・対戦可能な相手がめったに来ないランクの人ほど高い）"""
+    cost = PAIR_SKIP_COST + PAIR_WAIT_COST * min(waited, WAITING_SECONDS) / WAITING_SECONDS
+    if share is not None:
+        cost += PAIR_SCARCITY_COST * (1.0 - share.get(rank, 1.0))
+    return cost
+
+def batch_pairs(players, max_gap: int, share: dict = None):
+    """
+    players: [(user_id, 内部ランク, 待ち秒数)] から、ランク差 < max_gap のペアを選ぶ
+    コスト = 組んだペアのランク差 × PAIR_GAP_COST + 見送った人の pair_skip_cost()
+    を最小にする。長く待っている人や、対戦可能な相手が来にくいランクの人ほど、多少ランク差があっても組まれやすい
+    share: ランク -> 対戦可能な相手の割合（MatchQueue.compatible_share()）。None なら待ち時間だけで決める
+    - PAIR_EXACT_MAX 人以下: ビットDP（O(2^n n)）で厳密解
+    - それより多い: (ランク, 待ち時間の長い順) に並べ、直前 PAIR_WINDOW 人だけを相手候補にする DP（O(n log n)）
+    """
+    if len(players) < 2:
+        return []
+    skip = [pair_skip_cost(rank, w, share) for _, rank, w in players]
+    if len(players) <= PAIR_EXACT_MAX:
+        return _exact_pairs(players, skip, max_gap)
+    order = sorted(range(len(players)), key=lambda i: (players[i][1], -players[i][2]))
+    ranks = [players[i][1] for i in order]
+    skips = [skip[i] for i in order]
+    n = len(order)
+    skip_sum = [0.0] * (n + 1)
+    for i in range(n):
+        skip_sum[i + 1] = skip_sum[i] + skips[i]
+    # dp[i] = 先頭 i 人の最小コスト、choice[i] = i-1 番目の相手（見送りなら -1）
+    dp = [0.0] * (n + 1)
+    choice = [-1] * (n + 1)
+    for i in range(n):
+        best = dp[i] + skips[i]
+        partner = -1
+        for j in range(max(0, i - PAIR_WINDOW), i):
+            gap = ranks[i] - ranks[j]
+            if gap >= max_gap:
+                continue
+            # j と i を組み、間の人は見送る
+            cost = dp[j] + gap * PAIR_GAP_COST + (skip_sum[i] - skip_sum[j + 1])
+            if cost < best:
+                best = cost
+                partner = j
+        dp[i + 1] = best
+        choice[i + 1] = partner
+    pairs = []
+    i = n
+    while i > 0:
+        j = choice[i]
+        if j < 0:
+            i -= 1
+        else:
+            pairs.append((players[order[j]][0], players[order[i - 1]][0]))
+            i = j
+    pairs.reverse()
+    return pairs
+
+def _exact_pairs(players, skip, max_gap: int):
+    n = len(players)
+    ranks = [rank for _, rank, _ in players]
+    memo = {0: (0.0, ())}
+
+    def best(mask):
+        if mask in memo:
+            return memo[mask]
+        i = (mask & -mask).bit_length() - 1  # 残りの先頭の人を、見送るか誰かと組む
+        rest = mask & ~(1 << i)
+        cost, pairs = best(rest)
+        result = (cost + skip[i], pairs)
+        m = rest
+        while m:
+            j = (m & -m).bit_length() - 1
+            m &= m - 1
+            gap = abs(ranks[i] - ranks[j])
+            if gap >= max_gap:
+                continue
+            cost, pairs = best(rest & ~(1 << j))
+            cost += gap * PAIR_GAP_COST
+            if cost < result[0]:
+                result = (cost, pairs + ((i, j),))
+        memo[mask] = result
+        return result
+
+    _, pairs = best((1 << n) - 1)
+    return [(players[i][0], players[j][0]) for i, j in pairs]
+
+def add_waiting(user_id: int, info: dict):
+    waiting_list[user_id] = info
+    match_queue.add(user_id, get_user_pt(user_id))
+    session_store.waiting_added(user_id, info["expires"].timestamp())
+
+def pop_waiting(user_id: int):
+    match_queue.remove(user_id)
+    session_store.waiting_removed(user_id)
+    return waiting_list.pop(user_id, None)
+
 # ========================================
 # イベントチャンネル制御
 # ========================================
@@ -118,14 +2199,14 @@ async def set_matching_channel_permission(bot, allow: bool):
     MATCHING_CHANNEL を一般ユーザー向けに公開／非公開化する
     allow=True で全員が書き込み可能、False でBot/管理者のみ
     """
-    channel = bot.get_channel(MATCHING_CHANNEL_ID)
+    channel = guild_cache.channel(MATCHING_CHANNEL_ID)
     if not channel:
         print("[ERROR] MATCHING_CHANNEL が見つかりません。")
         return
 
     guild = channel.guild
     everyone = guild.default_role
-    admin_member = guild.get_member(ADMIN_ID)
+    admin_member = member_or_object(guild, ADMIN_ID)
 
     try:
         if allow:
@@ -136,7 +2217,7 @@ async def set_matching_channel_permission(bot, allow: bool):
             }
             if admin_member:
                 overwrites[admin_member] = discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True)
-            await channel.edit(overwrites=overwrites)
+            await rest.call(PRIORITY_BACKGROUND, "channel_manage", lambda: channel.edit(overwrites=overwrites))
             print("[イベント制御] MATCHING_CHANNEL を公開しました。")
         else:
             # 非公開: everyone は不可、Bot と管理者だけ可
@@ -146,7 +2227,7 @@ async def set_matching_channel_permission(bot, allow: bool):
             }
             if admin_member:
                 overwrites[admin_member] = discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True)
-            await channel.edit(overwrites=overwrites)
+            await rest.call(PRIORITY_BACKGROUND, "channel_manage", lambda: channel.edit(overwrites=overwrites))
             print("[イベント制御] MATCHING_CHANNEL をプライベート化しました。")
 
         event_config["active"] = allow
@@ -166,169 +2247,520 @@ async def post_event_notice(bot, message: str, to_matching_channel: bool = False
         return
 
     if to_matching_channel:
-        ch = guild.get_channel(MATCHING_CHANNEL_ID)
+        ch = guild_cache.channel(MATCHING_CHANNEL_ID)
     else:
-        ch = guild.get_channel(1427835216830926958)  # #お知らせ
+        ch = guild_cache.channel(NOTICE_CHANNEL_ID)
 
     if ch:
-        await ch.send(message)
+        await rest.call(PRIORITY_BACKGROUND, f"channel:{ch.id}", lambda: ch.send(message))
 
 
 # ========================================
-# イベントスケジューラー（最終修正版）
+# イベントスケジューラー（切替時刻までスリープ）
 # ========================================
-async def event_scheduler_loop(bot):
-    await bot.wait_until_ready()
-    notice_ch = bot.get_channel(1427835216830926958)  # #お知らせ
-    while True:
-        now = now_jst()
-
-        # 単発イベント
-        if event_config["type"] == "single":
-            start, end = event_config["dates"]
-            if start <= now < end and not event_config["active"]:
-                event_config["active"] = True
-                await set_matching_channel_permission(bot, True)
-                if notice_ch:
-                    await notice_ch.send("対戦開始！ #対戦相手募集 でマッチングが可能です")
-            elif now >= end and event_config["active"]:
-                event_config["active"] = False
-                await set_matching_channel_permission(bot, False)
-                if notice_ch:
-                    await notice_ch.send("対戦終了！マッチ希望を締め切ります")
-
-        # 長期イベント（複数時間帯対応）
-        elif event_config["type"] == "long":
-            start_date, end_date = event_config["dates"]
-            today = now.date()
+def compile_event_transitions(config: dict):
+    """
+    event_config を開始/終了の切替時刻の昇順リスト [(datetime, active), ...] にする
+    長期イベントは日ごとの時間帯を展開し、重なる時間帯はまとめる
+    """
+    if config["type"] == "single":
+        start, end = config["dates"]
+        return [(start, True), (end, False)]
+    if config["type"] != "long":
+        return []
+    start_date, end_date = config["dates"]
+    windows = []
+    day = start_date
+    while day <= end_date:
+        for t_start, t_end in config["times"]:
+            start_dt = datetime.combine(day, t_start, JST)
+            end_dt = datetime.combine(day, t_end, JST)
+            if start_dt < end_dt:
+                windows.append((start_dt, end_dt))
+        day += timedelta(days=1)
+    windows.sort()
+    transitions = []
+    for start_dt, end_dt in windows:
+        if transitions and start_dt <= transitions[-1][0]:
+            # 直前の時間帯と重なる/連続するなら終了時刻だけ延ばす
+            transitions[-1] = (max(transitions[-1][0], end_dt), False)
+            continue
+        transitions.append((start_dt, True))
+        transitions.append((end_dt, False))
+    return transitions
 
-            if start_date <= today <= end_date:
-                active_in_any = False
-                for t_start, t_end in event_config["times"]:
-                    start_dt = datetime.combine(today, t_start, JST)
-                    end_dt = datetime.combine(today, t_end, JST)
-                    if start_dt <= now < end_dt:
-                        active_in_any = True
-                        break  # 1つでも該当時間帯があればOK
+class EventScheduler:
+    """
+    次の切替時刻までスリープし、その時刻にマッチングチャンネルを開閉する
+    イベント設定コマンドは wake() で切替表を作り直してすぐに起こす
+    """
+    MAX_SLEEP = 3600  # 時計のずれ補正のため、長くてもこの秒数で見直す
+
+    def __init__(self):
+        self.wakeup = asyncio.Event()
+        self.transitions = []
+        self.times = []
+
+    def compile(self):
+        self.transitions = compile_event_transitions(event_config)
+        self.times = [t for t, _ in self.transitions]
+
+    def wake(self):
+        self.compile()
+        self.wakeup.set()
+
+    def desired_state(self, now: datetime):
+        if event_config["type"] == "unlimited":
+            return True
+        if event_config["type"] is None:
+            return None
+        idx = bisect.bisect_right(self.times, now) - 1
+        return self.transitions[idx][1] if idx >= 0 else False
+
+    def next_transition(self, now: datetime):
+        idx = bisect.bisect_right(self.times, now)
+        return self.times[idx] if idx < len(self.times) else None
+
+    async def run(self, bot):
+        await bot.wait_until_ready()
+        self.compile()
+        while True:
+            self.wakeup.clear()
+            now = now_jst()
+            want = self.desired_state(now)
+            if want is not None and want != event_config["active"]:
+                event_config["active"] = want
+                await set_matching_channel_permission(bot, want)
+                notice_ch = guild_cache.channel(NOTICE_CHANNEL_ID)
+                if notice_ch:
+                    if not want:
+                        notice = "対戦終了！マッチ希望を締め切ります"
+                    elif event_config["type"] == "unlimited":
+                        notice = "いつでもマッチング可能です"
+                    else:
+                        notice = "対戦開始！ #対戦相手募集 でマッチングが可能です"
+                    try:
+                        await rest.call(PRIORITY_BACKGROUND, f"channel:{notice_ch.id}", lambda: notice_ch.send(notice))
+                    except Exception as e:
+                        print(f"[ERROR] イベント通知の送信に失敗しました: {e}")
 
-                if active_in_any and not event_config["active"]:
-                    event_config["active"] = True
-                    await set_matching_channel_permission(bot, True)
-                    if notice_ch:
-                        await notice_ch.send("対戦開始！ #対戦相手募集 でマッチングが可能です")
-                elif not active_in_any and event_config["active"]:
-                    event_config["active"] = False
-                    await set_matching_channel_permission(bot, False)
-                    if notice_ch:
-                        await notice_ch.send("対戦終了！マッチ希望を締め切ります")
+            nxt = self.next_transition(now)
+            timeout = None if nxt is None else min((nxt - now).total_seconds(), self.MAX_SLEEP)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
 
-        # 無制限イベント
-        elif event_config["type"] == "unlimited" and not event_config["active"]:
-            event_config["active"] = True
-            await set_matching_channel_permission(bot, True)
-            if notice_ch:
-                await notice_ch.send("いつでもマッチング可能です")
+event_scheduler = EventScheduler()
 
-        await asyncio.sleep(30)
 
+# ----------------------------------------
+# ログ投稿のバッファリング（BATTLELOG / ACTIVE_LOG）
+# ----------------------------------------
+class LogSink:
+    """
+    ログチャンネルへの投稿をまとめて送る
+    - チャンネルごとにバッファし、flush_seconds ごとか max_lines 溜まった時点で1メッセージにまとめて送る
+    - 投稿順は維持し、2000文字を超える分は複数メッセージに分ける
+    - バッファが max_buffer を超えたら古い行から捨てて dropped に数える
+    """
+    MAX_CHARS = 2000
+
+    def __init__(self, flush_seconds: float, max_lines: int, max_buffer: int):
+        self.flush_seconds = flush_seconds
+        self.max_lines = max_lines
+        self.max_buffer = max_buffer
+        self.buffers = {}       # channel_id -> deque[str]
+        self.dropped = 0
+        self.dropped_pending = {}  # channel_id -> 次の投稿で知らせる破棄件数
+        self.has_data = asyncio.Event()
+        self.full = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    def post(self, channel_id: int, line: str):
+        if not channel_id:
+            return
+        buf = self.buffers.setdefault(channel_id, deque())
+        if len(buf) >= self.max_buffer:
+            buf.popleft()
+            self.dropped += 1
+            self.dropped_pending[channel_id] = self.dropped_pending.get(channel_id, 0) + 1
+            metrics.inc("kurisu_log_dropped_total", (("channel", channel_id),))
+        buf.append(line)
+        self.has_data.set()
+        if len(buf) >= self.max_lines:
+            self.full.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await self.has_data.wait()
+            try:
+                await asyncio.wait_for(self.full.wait(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def _chunks(self, lines):
+        chunk = []
+        length = 0
+        for line in lines:
+            line = line[:self.MAX_CHARS]
+            if chunk and length + len(line) + 1 > self.MAX_CHARS:
+                yield "\n".join(chunk)
+                chunk = []
+                length = 0
+            chunk.append(line)
+            length += len(line) + 1
+        if chunk:
+            yield "\n".join(chunk)
+
+    async def flush(self):
+        async with self.lock:
+            self.has_data.clear()
+            self.full.clear()
+            for channel_id, buf in list(self.buffers.items()):
+                if not buf:
+                    continue
+                lines = list(buf)
+                buf.clear()
+                dropped = self.dropped_pending.pop(channel_id, 0)
+                if dropped:
+                    lines.insert(0, f"（ログが多すぎたため {dropped} 件を省略しました）")
+                ch = guild_cache.channel(channel_id)
+                if not ch:
+                    continue
+                for content in self._chunks(lines):
+                    try:
+                        await rest.call(PRIORITY_BACKGROUND, f"channel:{channel_id}", lambda: ch.send(content))
+                    except Exception as e:
+                        print(f"[ERROR] ログ投稿に失敗しました ({channel_id}): {e}")
 
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        await self.flush()
 
+log_sink = LogSink(LOG_FLUSH_SECONDS, LOG_FLUSH_LINES, LOG_BUFFER_MAX)
 
 # ----------------------------------------
 # アクティブ状況ログ投稿（イベント別）
 # ----------------------------------------
-async def post_active_event(event_type: str):
+def post_active_event(event_type: str):
     """
     event_type:
       - "match_request" : /マッチ希望 が出たとき -> "マッチ希望が出ました"
       - "match_end"     : 対戦が終了したとき -> "対戦が終了しました"
-    This posts a new message to ACTIVE_LOG_CHANNEL_ID (if set).
+    This queues a line for ACTIVE_LOG_CHANNEL_ID (if set) via log_sink.
     """
-    if not ACTIVE_LOG_CHANNEL_ID:
-        return
-    guild = bot.get_guild(GUILD_ID)
-    if not guild:
-        return
-    ch = guild.get_channel(ACTIVE_LOG_CHANNEL_ID)
-    if not ch:
-        return
-    try:
-        if event_type == "match_request":
-            await ch.send("マッチ希望が出ました")
-        elif event_type == "match_end":
-            await ch.send("対戦が終了しました")
-    except Exception as e:
-        print(f"Failed to post active event ({event_type}): {e}")
+    if event_type == "match_request":
+        log_sink.post(ACTIVE_LOG_CHANNEL_ID, "マッチ希望が出ました")
+    elif event_type == "match_end":
+        log_sink.post(ACTIVE_LOG_CHANNEL_ID, "対戦が終了しました")
 
 # ----------------------------------------
-# マッチング処理
+# 対戦チャンネルプール
 # ----------------------------------------
-async def try_match_users():
-    users = list(waiting_list.keys())
-    random.shuffle(users)
-    matched = set()
-    for i in range(len(users)):
-        if users[i] in matched:
-            continue
-        for j in range(i + 1, len(users)):
-            if users[j] in matched:
+class BattleChannelPool:
+    """
+    BATTLE_CATEGORY_ID 配下に非公開の対戦チャンネルを作り置きしておく
+    - lease(): 待機チャンネルの権限だけを差し替えて貸し出す（無ければ新規作成）
+    - release(): メッセージを消して非公開に戻し、プールへ返す（max を超える分は削除）
+    - 名前は battle-pool-N のまま変えない（チャンネル名の変更は 10 分に 2 回までで、超えると長時間待たされる）
+      対戦者は最初のメッセージで示す
+    - 待機チャンネルが min を下回ったらバックグラウンドで補充する
+    """
+    PREFIX = "battle-pool-"
+
+    def __init__(self, min_size: int, max_size: int):
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.idle = []          # 待機中のチャンネルID
+        self.leased = set()     # 貸出中のチャンネルID
+        self.refill_needed = asyncio.Event()
+        self.task = None
+
+    def hidden_overwrites(self, guild: discord.Guild):
+        return {
+            guild.default_role: discord.PermissionOverwrite(view_channel=False),
+            guild.me: discord.PermissionOverwrite(view_channel=True, send_messages=True, manage_channels=True, manage_messages=True),
+        }
+
+    def is_leased_shape(self, guild: discord.Guild, channel: discord.TextChannel):
+        """@everyone と bot 自身以外の権限が付いていれば貸出中の状態"""
+        hidden = (guild.default_role.id, guild.me.id)
+        return any(target.id not in hidden for target in channel.overwrites)
+
+    def start(self, guild: discord.Guild):
+        if self.task is not None:
+            return  # 再接続で on_ready が再度呼ばれた場合
+        category = guild_cache.channel(BATTLE_CATEGORY_ID)
+        orphans = []
+        if category:
+            for ch in category.text_channels:
+                if not ch.name.startswith("battle-") or ch.id in self.leased:
+                    continue
+                # 前回の起動で貸し出したまま復元されなかった対戦チャンネル（旧形式の名前を含む）はプールへ戻す
+                if not ch.name.startswith(self.PREFIX) or self.is_leased_shape(guild, ch):
+                    orphans.append(ch)
+                else:
+                    self.idle.append(ch.id)
+        print(f"[INFO] 対戦チャンネルプール: 待機 {len(self.idle)} 件 / 片付け {len(orphans)} 件")
+        for ch in orphans:
+            self.leased.add(ch.id)
+            asyncio.create_task(self.release(ch))
+        self.task = asyncio.create_task(self.refill_loop())
+        self.refill_needed.set()
+
+    async def refill_loop(self):
+        while True:
+            await self.refill_needed.wait()
+            self.refill_needed.clear()
+            guild = bot.get_guild(GUILD_ID)
+            category = guild_cache.channel(BATTLE_CATEGORY_ID) if guild else None
+            if not category:
                 continue
-            u1, u2 = users[i], users[j]
-            pt1 = user_data.get(u1, {}).get("pt", 0)
-            pt2 = user_data.get(u2, {}).get("pt", 0)
-            rank1 = get_internal_rank(pt1)
-            rank2 = get_internal_rank(pt2)
-            if abs(rank1 - rank2) >= 3:
+            while len(self.idle) < self.min_size:
+                try:
+                    ch = await rest.call(PRIORITY_BACKGROUND, "channel_manage", lambda: guild.create_text_channel(
+                        self._pool_name(guild), category=category, overwrites=self.hidden_overwrites(guild)))
+                except Exception as e:
+                    print(f"[ERROR] 対戦チャンネルの作成に失敗しました: {e}")
+                    break
+                self.idle.append(ch.id)
+
+    def _pool_name(self, guild: discord.Guild):
+        used = {ch.name for ch in guild.text_channels if ch.name.startswith(self.PREFIX)}
+        n = 1
+        while f"{self.PREFIX}{n}" in used:
+            n += 1
+        return f"{self.PREFIX}{n}"
+
+    async def lease(self, guild: discord.Guild, overwrites: dict):
+        while self.idle:
+            ch = guild.get_channel(self.idle.pop())
+            if ch is None:
                 continue
+            self.refill_needed.set()
+            try:
+                await rest.call(PRIORITY_INTERACTION, "channel_manage", lambda: ch.edit(overwrites=overwrites))
+            except Exception as e:
+                print(f"[ERROR] 対戦チャンネルの貸し出しに失敗しました: {e}")
+                continue
+            self.leased.add(ch.id)
+            return ch
+        self.refill_needed.set()
+        # プールが空なら従来通りその場で作る
+        category = guild_cache.channel(BATTLE_CATEGORY_ID)
+        ch = await rest.call(PRIORITY_INTERACTION, "channel_manage", lambda: guild.create_text_channel(
+            self._pool_name(guild), category=category, overwrites=overwrites))
+        self.leased.add(ch.id)
+        return ch
+
+    async def release(self, channel: discord.TextChannel):
+        self.leased.discard(channel.id)
+        try:
+            if len(self.idle) >= self.max_size:
+                await rest.call(PRIORITY_BACKGROUND, "channel_manage", lambda: channel.delete())
+                return
+            # 先に非公開に戻してからメッセージを消す（名前は旧形式のものだけ1回付け直す）
+            if channel.name.startswith(self.PREFIX):
+                await rest.call(PRIORITY_BACKGROUND, "channel_manage", lambda: channel.edit(
+                    overwrites=self.hidden_overwrites(channel.guild)))
+            else:
+                await rest.call(PRIORITY_BACKGROUND, "channel_manage", lambda: channel.edit(
+                    name=self._pool_name(channel.guild), overwrites=self.hidden_overwrites(channel.guild)))
+            await rest.call(PRIORITY_BACKGROUND, f"channel:{channel.id}", lambda: channel.purge(limit=None))
+            self.idle.append(channel.id)
+        except Exception as e:
+            print(f"[ERROR] 対戦チャンネルの返却に失敗しました: {e}")
+            try:
+                await rest.call(PRIORITY_BACKGROUND, "channel_manage", lambda: channel.delete())
+            except Exception:
+                pass
+            self.refill_needed.set()
+
+battle_pool = BattleChannelPool(BATTLE_POOL_MIN, BATTLE_POOL_MAX)
 
-            # マッチ成立
-            matching[u1] = u2
-            matching[u2] = u1
-
-            # 待機タスク削除（ただし interaction は保持しておき、下で編集）
-            for uid in [u1, u2]:
-                task = waiting_list[uid]["task"]
-                task.cancel()
-
-            # 専用チャンネル作成
-            guild = bot.get_guild(GUILD_ID)
-            category = guild.get_channel(BATTLE_CATEGORY_ID)
-            overwrites = {
-                guild.default_role: discord.PermissionOverwrite(view_channel=False),
-                guild.get_member(u1): discord.PermissionOverwrite(view_channel=True, send_messages=True),
-                guild.get_member(u2): discord.PermissionOverwrite(view_channel=True, send_messages=True),
-                guild.get_member(ADMIN_ID): discord.PermissionOverwrite(view_channel=True, send_messages=True, manage_channels=True),
-                guild.me: discord.PermissionOverwrite(view_channel=True, send_messages=True, manage_channels=True)
-            }
-            channel_name = f"battle-{u1}-vs-{u2}"
-            battle_ch = await guild.create_text_channel(channel_name, category=category, overwrites=overwrites)
-            matching_channels[u1] = battle_ch.id
-            matching_channels[u2] = battle_ch.id
-
-            # 降参ボタンを含む初期メッセージ
-            await battle_ch.send(
-                f"<@{u1}> vs <@{u2}> のマッチングが成立しました。\n試合終了後、勝者は /勝利報告 を行ってください。\nこのチャンネルからは降参ボタンで即時敗北申告ができます（押した側が敗北）。",
-                view=ForfeitView(u1, u2, battle_ch.id)
-            )
-
-            # 待機メッセージ更新（元の ephemeral メッセージの差し替えを試みる）
-            for uid in [u1, u2]:
-                interaction = waiting_list.get(uid, {}).get("interaction")
-                if interaction:
-                    try:
-                        await interaction.edit_original_response(
-                            content=f"✅ マッチング成立！ 専用チャンネル <#{battle_ch.id}> で試合を行ってください。",
-                            view=None
-                        )
-                    except Exception:
-                        # interaction が無効（ブラウザ更新など）なら無視
-                        pass
-                # remove from waiting list now
-                waiting_list.pop(uid, None)
+# ----------------------------------------
+# マッチング処理
+# ----------------------------------------
+async def try_match_users():
+    # ペア決定は await を挟まずに一括で行う（途中で待機リストが変わっても二重マッチしない）
+    if MATCH_MODE == "batch":
+        now = datetime.now(JST)
+        waited = {uid: WAITING_SECONDS - (info["expires"] - now).total_seconds() for uid, info in waiting_list.items()}
+        pairs = match_queue.take_pairs_batch(waited)
+    else:
+        pairs = match_queue.take_pairs()
+    interactions = {}
+    for u1, u2 in pairs:
+        matching[u1] = u2
+        matching[u2] = u1
+        # 待機リストからはここで外す（interaction は保持しておき、下で編集）
+        for uid in [u1, u2]:
+            waiting_timers.cancel(uid)
+            interactions[uid] = (pop_waiting(uid) or {}).get("interaction")
+    # チャンネル準備は REST 待ちが大半なので並行して進める（同時実行数は rest 側で制限）
+    results = await asyncio.gather(*(start_battle(u1, u2, interactions) for u1, u2 in pairs), return_exceptions=True)
+    for (u1, u2), result in zip(pairs, results):
+        if isinstance(result, Exception):
+            print(f"[ERROR] 対戦開始に失敗しました ({u1} vs {u2}): {result}")
+            await abort_battle(u1, u2, interactions)
+    return pairs
+
+async def abort_battle(u1: int, u2: int, interactions: dict):
+    """start_battle が途中で失敗したペアを「マッチ済み」から外し、待機メッセージでやり直しを促す"""
+    channel_ids = set()
+    for uid in [u1, u2]:
+        matching.pop(uid, None)
+        channel_id = matching_channels.pop(uid, None)
+        if channel_id:
+            channel_ids.add(channel_id)
+    guild = bot.get_guild(GUILD_ID)
+    for channel_id in channel_ids:
+        session_store.match_ended(channel_id)
+        battle_ch = guild.get_channel(channel_id) if guild else None
+        if battle_ch:
+            asyncio.create_task(battle_pool.release(battle_ch))
+    for uid in [u1, u2]:
+        interaction = interactions.get(uid)
+        if interaction:
+            try:
+                await rest.call(PRIORITY_INTERACTION, "interaction", lambda: interaction.edit_original_response(
+                    content=f"⚠ <@{uid}> さん、対戦チャンネルの準備に失敗しました。もう一度お試しください。",
+                    view=RetryView(uid)
+                ))
+            except Exception:
+                pass
+
+async def start_battle(u1: int, u2: int, interactions: dict):
+    # 専用チャンネル（プールから貸し出し）
+    guild = bot.get_guild(GUILD_ID)
+    overwrites = {
+        guild.default_role: discord.PermissionOverwrite(view_channel=False),
+        member_or_object(guild, u1): discord.PermissionOverwrite(view_channel=True, send_messages=True),
+        member_or_object(guild, u2): discord.PermissionOverwrite(view_channel=True, send_messages=True),
+        member_or_object(guild, ADMIN_ID): discord.PermissionOverwrite(view_channel=True, send_messages=True, manage_channels=True),
+        guild.me: discord.PermissionOverwrite(view_channel=True, send_messages=True, manage_channels=True)
+    }
+    battle_ch = await battle_pool.lease(guild, overwrites)
+    matching_channels[u1] = battle_ch.id
+    matching_channels[u2] = battle_ch.id
+    session_store.match_started(battle_ch.id, u1, u2)
+
+    # 降参ボタンを含む初期メッセージ
+    await rest.call(PRIORITY_INTERACTION, f"channel:{battle_ch.id}", lambda: battle_ch.send(
+        f"<@{u1}> vs <@{u2}> のマッチングが成立しました。\n試合終了後、勝者は /勝利報告 を行ってください。\nこのチャンネルからは降参ボタンで即時敗北申告ができます（押した側が敗北）。",
+        view=ForfeitView(u1, u2, battle_ch.id)
+    ))
+
+    # 待機メッセージ更新（元の ephemeral メッセージの差し替えを試みる）
+    for uid in [u1, u2]:
+        interaction = interactions.get(uid)
+        if interaction:
+            try:
+                await rest.call(PRIORITY_INTERACTION, "interaction", lambda: interaction.edit_original_response(
+                    content=f"✅ マッチング成立！ 専用チャンネル <#{battle_ch.id}> で試合を行ってください。",
+                    view=None
+                ))
+            except Exception:
+                # interaction が無効（ブラウザ更新など）なら無視
+                pass
+    # NOTE: Do not post "match_request" here; we post on request creation.
 
-            matched.update([u1, u2])
-            # NOTE: Do not post "match_request" here; we post on request creation.
-            break
+# ----------------------------------------
+# マッチングスケジューラー
+# ----------------------------------------
+class MatchScheduler:
+    """
+    マッチ希望をまとめて1回のマッチング処理にする
+    - request() は即座に戻り、処理は常駐タスク1本で行うので同時に2回走ることはない
+    - 最後の request から debounce 秒静かになるか、最初の request から max_latency 秒経ったら実行
+    """
+    def __init__(self, debounce: float, max_latency: float):
+        self.debounce = debounce
+        self.max_latency = max_latency
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.first_request = None
+        self.last_request = None
+        # 統計
+        self.requests = 0
+        self.passes = 0
+        self.matches = 0
+        self.pass_time_total = 0.0
+        self.pass_time_max = 0.0
+        self.match_latencies = deque(maxlen=1000)  # マッチ希望から成立までの秒数（直近分）
+
+    def request(self):
+        now = asyncio.get_running_loop().time()
+        if self.first_request is None:
+            self.first_request = now
+        self.last_request = now
+        self.requests += 1
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            # バースト中は静かになるまで待つ（ただし max_latency は超えない）
+            while True:
+                self.wakeup.clear()
+                deadline = min(self.last_request + self.debounce, self.first_request + self.max_latency)
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+            self.first_request = None
+            await self.run_pass()
+
+    async def run_pass(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        joined = {uid: info.get("joined", started) for uid, info in waiting_list.items()}
+        try:
+            pairs = await try_match_users()
+        except Exception as e:
+            print(f"[ERROR] マッチング処理に失敗しました: {e}")
+            pairs = []
+        elapsed = loop.time() - started
+        metrics.observe("kurisu_match_pass_seconds", elapsed)
+        self.passes += 1
+        self.matches += len(pairs)
+        self.pass_time_total += elapsed
+        self.pass_time_max = max(self.pass_time_max, elapsed)
+        for pair in pairs:
+            for uid in pair:
+                self.match_latencies.append(started - joined.get(uid, started))
+
+    def stats(self) -> dict:
+        latencies = sorted(self.match_latencies)
+        def pct(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+        return {
+            "requests": self.requests,
+            "passes": self.passes,
+            "matches": self.matches,
+            "requests_per_pass": self.requests / self.passes if self.passes else 0.0,
+            "pass_avg": self.pass_time_total / self.passes if self.passes else 0.0,
+            "pass_max": self.pass_time_max,
+            "latency_p50": pct(0.5),
+            "latency_p95": pct(0.95),
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
+
+match_scheduler = MatchScheduler(MATCH_DEBOUNCE_SECONDS, MATCH_MAX_LATENCY_SECONDS)
 
 # ----------------------------------------
 # 待機処理
@@ -336,19 +2768,16 @@ async def try_match_users():
 async def remove_waiting(user_id: int):
     if user_id in waiting_list:
         interaction = waiting_list[user_id]["interaction"]
-        try:
-            view = RetryView(user_id)
-            await interaction.edit_original_response(content=f"⏱ <@{user_id}> さん、マッチング相手が見つかりませんでした。", view=view)
-        except Exception:
-            pass
-        waiting_list.pop(user_id, None)
+        if interaction:  # 再起動で復元した待機には interaction が無い
+            try:
+                view = RetryView(user_id)
+                await rest.call(PRIORITY_INTERACTION, "interaction", lambda: interaction.edit_original_response(
+                    content=f"⏱ <@{user_id}> さん、マッチング相手が見つかりませんでした。", view=view))
+            except Exception:
+                pass
+        pop_waiting(user_id)
 
-async def waiting_timer(user_id: int):
-    try:
-        await asyncio.sleep(300)
-        await remove_waiting(user_id)
-    except asyncio.CancelledError:
-        pass
+waiting_timers = DeadlineQueue(remove_waiting)
 
 async def start_match_wish(interaction: discord.Interaction):
     uid = interaction.user.id
@@ -358,22 +2787,19 @@ async def start_match_wish(interaction: discord.Interaction):
     if uid in waiting_list:
         await interaction.response.send_message("すでに待機中です。", ephemeral=True)
         return
-    task = asyncio.create_task(waiting_timer(uid))
-    waiting_list[uid] = {"expires": datetime.now(JST)+timedelta(seconds=300), "task": task, "interaction": interaction}
+    now = asyncio.get_running_loop().time()
+    add_waiting(uid, {"expires": datetime.now(JST)+timedelta(seconds=WAITING_SECONDS), "joined": now, "interaction": interaction})
+    # 待機タイマーリセット（既存の待機ユーザーも含めて全員の期限を延長）
+    waiting_timers.extend_all(now + WAITING_SECONDS)
+    waiting_timers.schedule(uid, now + WAITING_SECONDS)
     view = CancelWaitingView(uid)
     await interaction.response.send_message("マッチング中です…", ephemeral=True, view=view)
 
     # post a short log to ACTIVE_LOG channel that a match request appeared
     # (user requested this behavior)
-    asyncio.create_task(post_active_event("match_request"))
+    post_active_event("match_request")
 
-    # 待機タイマーリセット（既存の待機ユーザーの timer を再起動）
-    for uid2, info in list(waiting_list.items()):
-        info["task"].cancel()
-        info["task"] = asyncio.create_task(waiting_timer(uid2))
-        info["interaction"] = info.get("interaction", interaction)
-    await asyncio.sleep(5)
-    await try_match_users()
+    match_scheduler.request()
 
 # ----------------------------------------
 # /マッチ希望 コマンド & ボタンビュー
@@ -382,12 +2808,14 @@ class CancelWaitingView(discord.ui.View):
     def __init__(self, user_id:int):
         super().__init__(timeout=None)
         self.user_id = user_id
+        # 再起動後も restore_sessions() で同じ custom_id のビューを登録し直せば押せる
+        self.cancel.custom_id = f"kurisu:cancel_wait:{user_id}"
 
     @discord.ui.button(label="キャンセル", style=discord.ButtonStyle.danger)
     async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
         if self.user_id in waiting_list:
-            waiting_list[self.user_id]["task"].cancel()
-            waiting_list.pop(self.user_id, None)
+            waiting_timers.cancel(self.user_id)
+            pop_waiting(self.user_id)
             await interaction.response.send_message("待機リストから削除しました。", ephemeral=True)
         self.stop()
 
@@ -395,11 +2823,14 @@ class RetryView(discord.ui.View):
     def __init__(self, user_id:int):
         super().__init__(timeout=None)
         self.user_id = user_id
+        # 押した人で処理するので custom_id は全員共通（起動時に1つ登録しておく）
+        self.retry.custom_id = "kurisu:retry_wait"
 
     @discord.ui.button(label="リトライ", style=discord.ButtonStyle.primary)
     async def retry(self, interaction: discord.Interaction, button: discord.ui.Button):
+        # stop() はしない（restore_sessions で登録した RetryView(0) は全員のボタンで共有しているので、
+        # 止めると他の人のリトライボタンまで反応しなくなる）
         await start_match_wish(interaction)
-        self.stop()
 
 @bot.tree.command(name="マッチ希望", description="ランダムマッチ希望")
 async def cmd_match_wish(interaction: discord.Interaction):
@@ -417,6 +2848,7 @@ class ForfeitView(discord.ui.View):
         self.user1 = user1
         self.user2 = user2
         self.channel_id = channel_id
+        self.forfeit.custom_id = f"kurisu:forfeit:{channel_id}"
 
     @discord.ui.button(label="降参", style=discord.ButtonStyle.danger)
     async def forfeit(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -426,12 +2858,12 @@ class ForfeitView(discord.ui.View):
             return
         winner = self.user2 if uid == self.user1 else self.user1
         loser = uid
+        # 結果反映（BATTLELOG・ACTIVE_LOG への投稿とチャンネル片付けも settle が手配する）
+        if not await settlement.settle(winner, loser, interaction.guild, self.channel_id, kind=HISTORY_FORFEIT):
+            await interaction.response.send_message("この試合の結果は既に確定しています。", ephemeral=True)
+            return
         # 公開で降参通知
         await interaction.response.send_message(f"<@{loser}> が降参しました。<@{winner}> の勝利です。", ephemeral=False)
-        # handle result (this will log to BATTLELOG and remove matching, delete channel, and also post active-event)
-        await handle_approved_result(winner, loser, interaction.guild, self.channel_id)
-        # handle_approved_result will post match_end to ACTIVE_LOG channel,
-        # so no extra post here to avoid duplication.
 
 # ----------------------------------------
 # /勝利報告 コマンド（相手指定不要）
@@ -447,11 +2879,16 @@ async def cmd_victory_report(interaction: discord.Interaction):
     if not loser_id:
         await interaction.response.send_message("相手情報が見つかりません。", ephemeral=True)
         return
+    # 自動承認も登録（異議が無ければ5分後に自動処理）。同じ試合への2回目以降の報告は受け付けない
+    if not settlement.report(battle_ch_id, winner.id, loser_id):
+        await interaction.response.send_message("この試合の結果は既に報告されています。", ephemeral=True)
+        return
+    session_store.result_reported(battle_ch_id, winner.id, loser_id, time.time() + AUTO_APPROVE_SECONDS)
     content = f"この試合の勝者は <@{winner.id}> です。結果に同意しますか？"
-    await interaction.channel.send(content, view=ResultApproveView(winner.id, loser_id, battle_ch_id))
+    # 応答は 3 秒制限があるので先に返し、承認メッセージは rest の順番で送る
     await interaction.response.send_message("結果報告を受け付けました。敗者の承認を待ちます。", ephemeral=True)
-    # 自動承認タスク（異議が無ければ5分後に自動処理）
-    asyncio.create_task(auto_approve_result(winner.id, loser_id, interaction.guild, battle_ch_id))
+    await rest.call(PRIORITY_INTERACTION, f"channel:{battle_ch_id}", lambda: interaction.channel.send(
+        content, view=ResultApproveView(winner.id, loser_id, battle_ch_id)))
 
 # ----------------------------------------
 # 結果承認・異議ビュー
@@ -463,135 +2900,362 @@ class ResultApproveView(discord.ui.View):
         self.loser_id = loser_id
         self.battle_ch_id = battle_ch_id
         self.processed = False
+        self.approve.custom_id = f"kurisu:approve:{battle_ch_id}"
+        self.dispute.custom_id = f"kurisu:dispute:{battle_ch_id}"
 
-    async def log_battle_result(self, guild: discord.Guild, result_text: str):
-        log_ch = guild.get_channel(BATTLELOG_CHANNEL_ID)
-        if log_ch:
-            await log_ch.send(result_text)
+    def log_battle_result(self, result_text: str):
+        log_sink.post(BATTLELOG_CHANNEL_ID, result_text)
 
     @discord.ui.button(label="承認", style=discord.ButtonStyle.success)
     async def approve(self, interaction: discord.Interaction, button: discord.ui.Button):
         if interaction.user.id != self.loser_id:
             await interaction.response.send_message("これはあなたの試合ではないようです。", ephemeral=True)
             return
-        if self.processed:
+        if self.processed or not await settlement.settle(self.winner_id, self.loser_id, interaction.guild, self.battle_ch_id):
             await interaction.response.send_message("既に処理済みです。", ephemeral=True)
             return
         self.processed = True
-        await interaction.response.edit_message(content="承認されました。結果を反映します。", view=None)
-        await handle_approved_result(self.winner_id, self.loser_id, interaction.guild, self.battle_ch_id)
-        # handle_approved_result posts match_end
+        await interaction.response.edit_message(content="承認されました。結果を反映しました。", view=None)
 
     @discord.ui.button(label="異議", style=discord.ButtonStyle.danger)
     async def dispute(self, interaction: discord.Interaction, button: discord.ui.Button):
         if interaction.user.id != self.loser_id:
             await interaction.response.send_message("これはあなたの試合ではないようです。", ephemeral=True)
             return
-        if self.processed:
+        if self.processed or not is_registered_match(self.winner_id, self.loser_id):
             await interaction.response.send_message("既に処理済みです。", ephemeral=True)
             return
         self.processed = True
-        await interaction.response.edit_message(content="異議が申立てられました。審議チャンネルへ通知します。", view=None)
-        judge_ch = interaction.guild.get_channel(JUDGE_CHANNEL_ID)
-        if judge_ch:
-            await judge_ch.send(f"⚖️ 審議依頼: <@{self.winner_id}> vs <@{self.loser_id}> に異議が出ました。結論が出たら<@{ADMIN_ID}> に連絡してください。")
+        settlement.withdraw(self.battle_ch_id)
         # 内部的にマッチ解除（対戦チャンネルは維持）
         matching.pop(self.winner_id, None)
         matching.pop(self.loser_id, None)
-        await self.log_battle_result(interaction.guild,
+        session_store.match_disputed(self.battle_ch_id)
+        await interaction.response.edit_message(content="異議が申立てられました。審議チャンネルへ通知します。", view=None)
+        judge_ch = guild_cache.channel(JUDGE_CHANNEL_ID)
+        if judge_ch:
+            await rest.call(PRIORITY_INTERACTION, f"channel:{judge_ch.id}", lambda: judge_ch.send(
+                f"⚖️ 審議依頼: <@{self.winner_id}> vs <@{self.loser_id}> に異議が出ました。結論が出たら<@{ADMIN_ID}> に連絡してください。"))
+        self.log_battle_result(
             f"[異議発生] {datetime.now(JST).strftime('%Y-%m-%d %H:%M:%S')} - <@{self.winner_id}> vs <@{self.loser_id}>")
         # post that a match ended (by dispute) to ACTIVE_LOG channel
-        asyncio.create_task(post_active_event("match_end"))
+        post_active_event("match_end")
 
 # ----------------------------------------
 # 結果反映処理
 # ----------------------------------------
-async def handle_approved_result(winner_id:int, loser_id:int, guild: discord.Guild, battle_ch_id:int):
-    if not is_registered_match(winner_id, loser_id):
-        return
-    winner_pt = user_data.get(winner_id, {}).get("pt", 0)
-    loser_pt  = user_data.get(loser_id, {}).get("pt", 0)
-    winner_new = calculate_pt(winner_pt, loser_pt, "win")
-    loser_new  = calculate_pt(loser_pt, winner_pt, "lose")
-    user_data.setdefault(winner_id, {})["pt"] = winner_new
-    user_data.setdefault(loser_id, {})["pt"] = loser_new
-
-    w_member = guild.get_member(winner_id)
-    l_member = guild.get_member(loser_id)
-    if w_member:
-        await update_member_display(w_member)
-    if l_member:
-        await update_member_display(l_member)
-
-    # 内部マッチ削除
-    matching.pop(winner_id, None)
-    matching.pop(loser_id, None)
-
-    log_ch = guild.get_channel(BATTLELOG_CHANNEL_ID)
-    # 対戦ログ記録（勝者確定）
-    if log_ch:
-        # include timestamps and mention formatting similar to user's request
+class ResultSettlement:
+    """
+    対戦結果の確定を試合（対戦チャンネル ID）ごとに1回だけ行う
+    - report(): /勝利報告 を登録し、自動承認の期限を auto_approvals に積む（同じ試合への再報告は False）
+    - settle(): 対戦状態の確認・pt 計算・対戦状態の削除を ledger.submit() の中でまとめて行う。
+      承認・降参・自動承認が重なっても反映されるのは最初の1回だけで、2回目以降は False を返す
+    - 表示更新・ログは既存のまとめ処理に渡し、チャンネルの片付けは close_timers で BATTLE_CLOSE_DELAY 後に行う
+    """
+    def __init__(self):
+        self.reports = {}  # channel_id -> (winner_id, loser_id)
+        self.auto_approvals = DeadlineQueue(self._auto_approve)
+        self.close_timers = DeadlineQueue(self._close_channel)
+
+    def report(self, channel_id: int, winner_id: int, loser_id: int, delay: float = AUTO_APPROVE_SECONDS) -> bool:
+        if channel_id in self.reports:
+            return False
+        self.reports[channel_id] = (winner_id, loser_id)
+        self.auto_approvals.schedule(channel_id, asyncio.get_running_loop().time() + delay)
+        return True
+
+    def withdraw(self, channel_id: int):
+        """異議などで報告を取り下げる"""
+        self.reports.pop(channel_id, None)
+        self.auto_approvals.cancel(channel_id)
+
+    async def settle(self, winner_id: int, loser_id: int, guild: discord.Guild, battle_ch_id: int, kind: int = HISTORY_RESULT) -> bool:
+        def apply(txn: LedgerTxn):
+            if not is_registered_match(winner_id, loser_id) or matching_channels.get(winner_id) != battle_ch_id:
+                return None
+            winner_pt = txn.get(winner_id)
+            loser_pt = txn.get(loser_id)
+            winner_new, loser_new = rating_engine.rate(winner_id, loser_id, winner_pt, loser_pt)
+            winner_new, loser_new = min(winner_new, PT_MAX), min(loser_new, PT_MAX)
+            txn.set(winner_id, winner_new)
+            txn.set(loser_id, loser_new)
+            txn.log(kind, winner_id, loser_id, winner_new, loser_new)
+
+            # 内部マッチ削除
+            for uid in (winner_id, loser_id):
+                matching.pop(uid, None)
+                if matching_channels.get(uid) == battle_ch_id:
+                    del matching_channels[uid]
+            self.withdraw(battle_ch_id)
+            session_store.match_ended(battle_ch_id)
+            return winner_pt, loser_pt, winner_new, loser_new
+
+        result = await ledger.submit((winner_id, loser_id), apply)
+        if result is None:
+            return False
+        winner_pt, loser_pt, winner_new, loser_new = result
+
+        update_member_display_by_id(guild, winner_id)
+        update_member_display_by_id(guild, loser_id)
+
+        # 対戦ログ記録（勝者確定）
         now_str = datetime.now(JST).strftime('%Y-%m-%d %H:%M:%S')
-        await log_ch.send(f"[勝者確定] {now_str} - <@{winner_id}> 勝利 vs <@{loser_id}> 敗北")
+        log_sink.post(BATTLELOG_CHANNEL_ID, f"[勝者確定] {now_str} - <@{winner_id}> 勝利 vs <@{loser_id}> 敗北")
         delta_w = winner_new - winner_pt
         delta_l = loser_new - loser_pt
-        await log_ch.send(f"✅ <@{winner_id}> に +{delta_w}pt／<@{loser_id}> に {delta_l}pt の反映を行いました。")
-
-    # 専用チャンネル削除（ただし10秒の事前通知）
-    battle_ch = guild.get_channel(battle_ch_id)
-    if battle_ch:
-        try:
-            await battle_ch.send("このチャンネルは自動的に削除されます（10秒後）。")
-        except Exception:
-            pass
-        # wait 10 seconds, then delete
-        await asyncio.sleep(10)
+        log_sink.post(BATTLELOG_CHANNEL_ID, f"✅ <@{winner_id}> に +{delta_w}pt／<@{loser_id}> に {delta_l}pt の反映を行いました。")
+        post_active_event("match_end")
+
+        # 専用チャンネルは事前通知してから BATTLE_CLOSE_DELAY 秒後にプールへ返却
+        battle_ch = guild.get_channel(battle_ch_id)
+        if battle_ch:
+            asyncio.create_task(self._close_notice(battle_ch))
+            self.close_timers.schedule(battle_ch_id, asyncio.get_running_loop().time() + BATTLE_CLOSE_DELAY)
+        return True
+
+    async def _auto_approve(self, channel_id: int):
+        report = self.reports.get(channel_id)
+        guild = bot.get_guild(GUILD_ID)
+        if report and guild:
+            await self.settle(report[0], report[1], guild, channel_id)
+
+    async def _close_notice(self, battle_ch):
         try:
-            await battle_ch.delete()
+            await rest.call(PRIORITY_BACKGROUND, f"channel:{battle_ch.id}", lambda: battle_ch.send(f"このチャンネルは自動的に閉じられます（{BATTLE_CLOSE_DELAY}秒後）。"))
         except Exception:
             pass
 
-    # post active-event: match ended
-    asyncio.create_task(post_active_event("match_end"))
+    async def _close_channel(self, channel_id: int):
+        guild = bot.get_guild(GUILD_ID)
+        battle_ch = guild.get_channel(channel_id) if guild else None
+        if battle_ch:
+            await battle_pool.release(battle_ch)
 
-async def auto_approve_result(winner_id:int, loser_id:int, guild: discord.Guild, battle_ch_id:int):
-    await asyncio.sleep(AUTO_APPROVE_SECONDS)
-    if is_registered_match(winner_id, loser_id):
-        await handle_approved_result(winner_id, loser_id, guild, battle_ch_id)
+settlement = ResultSettlement()
+
+# ----------------------------------------
+# 再起動後の状態復元
+# ----------------------------------------
+def restore_sessions(guild: discord.Guild, saved: dict):
+    """
+    session_store に残っていた状態をメモリに戻し、ボタンを押せるようにビューを登録し直す
+    - 対戦中: matching / matching_channels / ForfeitView（チャンネルが消えていれば破棄）
+    - 結果承認待ち: ResultApproveView と自動承認を残り時間で再設定
+    - 待機中: interaction は復元できないので None のまま待機に戻し、マッチングを1回走らせる
+    """
+    now = time.time()
+    loop_now = asyncio.get_running_loop().time()
+    bot.add_view(RetryView(0))
+
+    restored_matches = 0
+    for channel_id, (u1, u2, disputed) in saved["match"].items():
+        if guild.get_channel(channel_id) is None:
+            session_store.match_ended(channel_id)
+            continue
+        battle_pool.leased.add(channel_id)
+        if disputed:
+            continue  # 審議中のチャンネルは残すだけ
+        matching[u1] = u2
+        matching[u2] = u1
+        matching_channels[u1] = channel_id
+        matching_channels[u2] = channel_id
+        bot.add_view(ForfeitView(u1, u2, channel_id))
+        restored_matches += 1
+
+    restored_results = 0
+    for channel_id, (winner, loser, deadline) in saved["result"].items():
+        if not is_registered_match(winner, loser) or matching_channels.get(winner) != channel_id:
+            session_store.result_cleared(channel_id)
+            continue
+        bot.add_view(ResultApproveView(winner, loser, channel_id))
+        settlement.report(channel_id, winner, loser, delay=max(0.0, deadline - now))
+        restored_results += 1
+
+    # 待機者の期限は誰かが参加するたびに全員延長されるので、保存値の最大を全員に使う
+    waiting_deadline = max((deadline for (deadline,) in saved["waiting"].values()), default=0.0)
+    restored_waiting = 0
+    for uid in saved["waiting"]:
+        if waiting_deadline <= now or uid in matching or uid in waiting_list:
+            session_store.waiting_removed(uid)
+            continue
+        add_waiting(uid, {"expires": datetime.fromtimestamp(waiting_deadline, JST), "joined": loop_now, "interaction": None})
+        waiting_timers.schedule(uid, loop_now + waiting_deadline - now)
+        bot.add_view(CancelWaitingView(uid))
+        restored_waiting += 1
+    if restored_waiting:
+        match_scheduler.request()
+
+    print(f"[INFO] 状態を復元しました: 対戦 {restored_matches} 件 / 承認待ち {restored_results} 件 / 待機 {restored_waiting} 人")
 
 # ----------------------------------------
 # ランキング表示
 # ----------------------------------------
-def standard_competition_ranking():
-    sorted_users = sorted(user_data.items(), key=lambda x: x[1].get("pt",0), reverse=True)
-    result = []
+def standard_competition_ranking(store: PlayerStore = None):
+    """(順位, user_id, pt) を順に返す（同点は同順位、次の順位は人数分飛ぶ）。store を渡せば別スレッドからも使える"""
+    sorted_users = (store or player_store).sorted_by_pt()
     prev_pt = None
     rank = 0
     display_rank = 0
-    for uid, data in sorted_users:
-        pt = data.get("pt",0)
+    for uid, pt in sorted_users:
         display_rank += 1
         if pt != prev_pt:
             rank = display_rank
             prev_pt = pt
-        result.append((rank, uid, pt))
-    return result
+        yield rank, uid, pt
+
+class RankingRenderer:
+    """
+    /ランキング のページを組み立ててキャッシュする
+    - pt が変わったとき、または載っている人が抜けた・表示名を変えたときだけ invalidate() で作り直す
+    - 1ページは page_size 行以内かつ Discord の 2000 文字制限以内
+    """
+    HEADER = "🏆 ランキング"
+    MAX_CHARS = 1900  # ヘッダー分の余裕を残す
+
+    QUERY_CHUNK = 100  # query_members で1回に問い合わせる人数（Gateway の上限）
+
+    def __init__(self, page_size: int):
+        self.page_size = page_size
+        self.pages = None
+        self.shown = set()  # 今の pages に載っている user_id
+        self.names = {}  # LAZY_MEMBERS 用: user_id -> 表示名（サーバーにいなければ None）
+
+    def invalidate(self):
+        self.pages = None
+
+    def member_changed(self, user_id: int):
+        """メンバーの退出・表示名変更。ページに載っている人ならページも作り直す"""
+        self.names.pop(user_id, None)
+        if user_id in self.shown:
+            self.invalidate()
+
+    @staticmethod
+    def base_name(name: str) -> str:
+        """表示名から末尾の2語（ランク表示）を除いた名前"""
+        words = name.split()
+        return " ".join(words[:-2]) if len(words) > 2 else name
+
+    def get_pages(self, guild: discord.Guild):
+        if self.pages is None:
+            self.pages = self._render(guild)
+        return self.pages
+
+    def display_name(self, guild: discord.Guild, user_id: int):
+        member = member_cache.get(guild, user_id, fill=False)
+        if member is not None:
+            return member.display_name
+        return self.names.get(user_id)
+
+    def missing_names(self, guild: discord.Guild):
+        if not LAZY_MEMBERS or self.pages is not None:
+            return []
+        return [uid for uid in player_store
+                if uid not in self.names and member_cache.get(guild, uid, fill=False) is None]
+
+    async def prepare(self, guild: discord.Guild):
+        """表示名の分からない登録ユーザーを 100 人ずつ Gateway に問い合わせてから描画する"""
+        missing = self.missing_names(guild)
+        for i in range(0, len(missing), self.QUERY_CHUNK):
+            chunk = missing[i:i + self.QUERY_CHUNK]
+            try:
+                found = await guild.query_members(user_ids=chunk, limit=len(chunk), cache=False)
+            except Exception as e:
+                print(f"[ERROR] ランキング用のメンバー取得に失敗しました: {e}")
+                break
+            for uid in chunk:
+                self.names[uid] = None
+            for member in found:
+                self.names[member.id] = member.display_name
+        self.get_pages(guild)
+
+    def _render(self, guild: discord.Guild):
+        pages = []
+        current = []
+        length = 0
+        self.shown = set()
+        for rank, uid, pt in standard_competition_ranking():
+            name = self.display_name(guild, uid)
+            if not name:
+                continue
+            self.shown.add(uid)
+            role, icon = get_rank_info(pt)
+            line = f"{rank}位 {self.base_name(name)} {icon} {pt}pt"
+            if current and (len(current) >= self.page_size or length + len(line) + 1 > self.MAX_CHARS):
+                pages.append("\n".join(current))
+                current = []
+                length = 0
+            current.append(line)
+            length += len(line) + 1
+        if current:
+            pages.append("\n".join(current))
+        return pages or ["（まだランキングに登録されたユーザーがいません）"]
+
+    def page_content(self, guild: discord.Guild, page: int):
+        pages = self.get_pages(guild)
+        page = max(0, min(page, len(pages) - 1))
+        return page, f"{self.HEADER}（{page + 1}/{len(pages)}）\n{pages[page]}"
+
+ranking_renderer = RankingRenderer(RANKING_PAGE_SIZE)
+
+class RankingPageView(discord.ui.View):
+    def __init__(self, page: int = 0):
+        super().__init__(timeout=600)
+        self.page = page
+
+    def refresh_buttons(self, guild: discord.Guild):
+        last = len(ranking_renderer.get_pages(guild)) - 1
+        self.prev_page.disabled = self.page <= 0
+        self.next_page.disabled = self.page >= last
+
+    async def show(self, interaction: discord.Interaction, page: int):
+        if ranking_renderer.missing_names(interaction.guild):
+            # 名前の取得に時間がかかるので先に応答を保留する
+            await interaction.response.defer()
+            await ranking_renderer.prepare(interaction.guild)
+            self.page, content = ranking_renderer.page_content(interaction.guild, page)
+            self.refresh_buttons(interaction.guild)
+            await rest.call(PRIORITY_INTERACTION, "interaction", lambda: interaction.edit_original_response(content=content, view=self))
+            return
+        self.page, content = ranking_renderer.page_content(interaction.guild, page)
+        self.refresh_buttons(interaction.guild)
+        await interaction.response.edit_message(content=content, view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def prev_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.page + 1)
 
 @bot.tree.command(name="ランキング", description="PT順にランキング表示")
 async def cmd_ranking(interaction: discord.Interaction):
     if interaction.channel.id != RANKING_CHANNEL_ID:
         await interaction.response.send_message(f"このコマンドは <#{RANKING_CHANNEL_ID}> でのみ使用可能です。", ephemeral=True)
         return
-    rankings = standard_competition_ranking()
-    lines = []
-    for rank, uid, pt in rankings:
-        role, icon = get_rank_info(pt)
-        member = interaction.guild.get_member(uid)
-        if member:
-            words = member.display_name.split()
-            base_name = " ".join(words[:-2]) if len(words) > 2 else member.display_name
-            lines.append(f"{rank}位 {base_name} {icon} {pt}pt")
-    await interaction.response.send_message("🏆 ランキング\n" + "\n".join(lines))
+    send = interaction.response.send_message
+    if ranking_renderer.missing_names(interaction.guild):
+        await interaction.response.defer()
+        await ranking_renderer.prepare(interaction.guild)
+        send = interaction.followup.send
+    page, content = ranking_renderer.page_content(interaction.guild, 0)
+    if len(ranking_renderer.get_pages(interaction.guild)) == 1:
+        await send(content)
+        return
+    view = RankingPageView(page)
+    view.refresh_buttons(interaction.guild)
+    await send(content, view=view)
+
+@bot.tree.command(name="自分の順位", description="自分の現在の順位を表示")
+async def cmd_my_rank(interaction: discord.Interaction):
+    uid = interaction.user.id
+    rank = rank_index.rank(uid)
+    if rank is None:
+        await interaction.response.send_message("まだランキングに登録されていません。", ephemeral=True)
+        return
+    pt = get_user_pt(uid)
+    role, icon = get_rank_info(pt)
+    await interaction.response.send_message(f"現在 {rank}位（{len(rank_index)}人中） {icon} {pt}pt", ephemeral=True)
 
 # ----------------------------------------
 # 管理コマンド
@@ -602,8 +3266,13 @@ async def admin_set_pt(interaction: discord.Interaction, user: discord.Member, p
     if interaction.user.id != ADMIN_ID:
         await interaction.response.send_message("権限がありません。", ephemeral=True)
         return
-    user_data.setdefault(user.id, {})["pt"] = pt
-    await update_member_display(user)
+    if not 0 <= pt <= PT_MAX:
+        await interaction.response.send_message(f"PTは0〜{PT_MAX}の範囲で指定してください。", ephemeral=True)
+        return
+    async with ledger.transaction(user.id) as txn:
+        txn.set(user.id, pt)
+        txn.log(HISTORY_ADMIN_SET, user.id, pt_a=pt)
+    update_member_display(user)
     await interaction.response.send_message(f"{user.display_name} のPTを {pt} に設定しました。", ephemeral=True)
 
 @bot.tree.command(name="admin_reset_all", description="全ユーザーのPTを0にリセット")
@@ -611,13 +3280,230 @@ async def admin_reset_all(interaction: discord.Interaction):
     if interaction.user.id != ADMIN_ID:
         await interaction.response.send_message("権限がありません。", ephemeral=True)
         return
+    # 人数が多いと3秒以内に終わらないので先に応答を保留する
+    await interaction.response.defer(ephemeral=True, thinking=True)
     guild = bot.get_guild(GUILD_ID)
-    for member in guild.members:
-        if member.bot:
-            continue
-        user_data.setdefault(member.id, {})["pt"] = 0
-        await update_member_display(member)
-    await interaction.response.send_message("全ユーザーのPTを0にリセットしました。", ephemeral=True)
+    async with ledger.transaction_all() as txn:
+        for uid in player_store:
+            txn.set(uid, 0)
+        txn.log(HISTORY_ADMIN_RESET, 0)
+
+    # メンバーを少しずつ取得しながら、表示が変わるメンバーだけ更新する
+    checked = 0
+    async def targets():
+        nonlocal checked
+        async for m in iter_members(guild):
+            if m.bot:
+                continue
+            checked += 1
+            if m.id not in player_store:
+                set_user_pt(m.id, 0)  # 未登録者を 0pt で登録するだけなので台帳のロックは不要
+            if display_sync.target_changes(m):
+                display_sync.pending.pop(m.id, None)
+                yield m
+    updater = BulkDisplayUpdater(BULK_DISPLAY_WORKERS)
+    progress = await interaction.followup.send("PTを0にリセットしました。表示を更新中…", ephemeral=True, wait=True)
+    task = asyncio.create_task(updater.run(targets()))
+    while not task.done():
+        await asyncio.wait({task}, timeout=3)
+        if not task.done():
+            try:
+                await rest.call(PRIORITY_INTERACTION, "interaction", lambda: progress.edit(
+                    content=f"PTを0にリセットしました。表示を更新中… {updater.done}/{updater.total}（確認済み {checked} 人）"))
+            except Exception:
+                pass
+    await task
+    result = f"全ユーザーのPTを0にリセットしました。表示更新 {updater.updated} 人 / 変更なし {checked - updater.total} 人"
+    if updater.failed:
+        result += f" / 失敗 {updater.failed} 人"
+    try:
+        await rest.call(PRIORITY_INTERACTION, "interaction", lambda: progress.edit(content=result))
+    except Exception:
+        print(f"[ADMIN] {result}")
+
+@bot.tree.command(name="admin_match_stats", description="マッチングスケジューラーの統計を表示")
+async def admin_match_stats(interaction: discord.Interaction):
+    if interaction.user.id != ADMIN_ID:
+        await interaction.response.send_message("権限がありません。", ephemeral=True)
+        return
+    st = match_scheduler.stats()
+    await interaction.response.send_message(
+        "📊 マッチング統計\n"
+        f"設定: debounce {match_scheduler.debounce:.1f}s / 最大待ち {match_scheduler.max_latency:.1f}s\n"
+        f"マッチ希望 {st['requests']} 件 / 処理 {st['passes']} 回（1回あたり {st['requests_per_pass']:.1f} 件）\n"
+        f"成立 {st['matches']} 組 / 処理時間 平均 {st['pass_avg']*1000:.0f}ms 最大 {st['pass_max']*1000:.0f}ms\n"
+        f"待ち時間 p50 {st['latency_p50']:.1f}s / p95 {st['latency_p95']:.1f}s / 最大 {st['latency_max']:.1f}s",
+        ephemeral=True
+    )
+
+@bot.tree.command(name="admin_rest_stats", description="REST 呼び出しキューの統計を表示")
+async def admin_rest_stats(interaction: discord.Interaction):
+    if interaction.user.id != ADMIN_ID:
+        await interaction.response.send_message("権限がありません。", ephemeral=True)
+        return
+    lines = ["📊 REST キュー統計"]
+    for name, st in rest.summary().items():
+        lines.append(
+            f"{name}: 待ち {st['depth']} 件 / 完了 {st['done']} 件 / 失敗 {st['failed']} 件 / "
+            f"待ち時間 平均 {st['wait_avg']*1000:.0f}ms 最大 {st['wait_max']*1000:.0f}ms"
+        )
+    buffered = sum(len(buf) for buf in log_sink.buffers.values())
+    lines.append(f"ログ投稿: 送信待ち {buffered} 行 / 溢れて省略 {log_sink.dropped} 行")
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
+@bot.tree.command(name="admin_replay_history", description="履歴ログから pt を再計算して現在値と比較（apply=True で反映）")
+@app_commands.describe(apply="差分を現在の pt に反映する")
+async def admin_replay_history(interaction: discord.Interaction, apply: bool = False):
+    if interaction.user.id != ADMIN_ID:
+        await interaction.response.send_message("権限がありません。", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    # 反映する場合は再計算の間も全員のロックを持つ（途中で確定した試合の pt を上書きしないように）
+    async with (ledger.transaction_all() if apply else contextlib.nullcontext()) as txn:
+        await history_log.flush()
+        started = time.perf_counter()
+        replayed = await asyncio.to_thread(history_log.replay)
+        elapsed = time.perf_counter() - started
+        diffs = [(uid, pt) for uid, pt in replayed.items() if get_user_pt(uid) != pt]
+        if apply:
+            for uid, pt in diffs:
+                txn.set(uid, pt)
+    msg = f"履歴から {len(replayed)} 人分の pt を再計算しました（{elapsed*1000:.0f}ms）。現在値との差分 {len(diffs)} 人"
+    if diffs and apply:
+        msg += "（反映しました）"
+    await interaction.followup.send(msg, ephemeral=True)
+
+def run_rating_trial(engine_name: str):
+    """履歴の対戦を指定エンジンで全員 0pt から再計算し、(対戦数, 所要秒数, user_id -> pt) を返す"""
+    winners, losers = history_log.read_matches()
+    started = time.perf_counter()
+    if not winners:
+        return 0, 0.0, {}
+    uids, idx = np.unique(np.array(winners + losers, dtype=np.uint64), return_inverse=True)
+    n = len(winners)
+    engine = RATING_ENGINES[engine_name]()
+    pts = engine.batch(idx[:n], idx[n:], len(uids))
+    elapsed = time.perf_counter() - started
+    return n, elapsed, dict(zip(uids.tolist(), pts.tolist()))
+
+@bot.tree.command(name="admin_rating_trial", description="履歴の全対戦を別のレーティング方式で再計算して比較")
+@app_commands.describe(engine="レーティング方式")
+@app_commands.choices(engine=[app_commands.Choice(name=name, value=name) for name in RATING_ENGINES])
+async def admin_rating_trial(interaction: discord.Interaction, engine: app_commands.Choice[str]):
+    if interaction.user.id != ADMIN_ID:
+        await interaction.response.send_message("権限がありません。", ephemeral=True)
+        return
+    if np is None:
+        await interaction.response.send_message("numpy がインストールされていないため実行できません。", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    await history_log.flush()
+    n, elapsed, trial = await asyncio.to_thread(run_rating_trial, engine.value)
+    changed = sum(1 for uid, pt in trial.items() if get_user_pt(uid) != pt)
+    top = sorted(trial.items(), key=lambda x: x[1], reverse=True)[:10]
+    lines = [f"🧪 {engine.value} で {n} 試合を再計算しました（{elapsed*1000:.0f}ms）。現在の pt と異なる人: {changed} 人"]
+    for i, (uid, pt) in enumerate(top, 1):
+        lines.append(f"{i}. <@{uid}> {pt}pt（現在 {get_user_pt(uid)}pt）")
+    await interaction.followup.send("\n".join(lines), ephemeral=True)
+
+# ----------------------------------------
+# データ出力（ランキング・履歴）
+# ----------------------------------------
+HISTORY_KIND_NAMES = {
+    HISTORY_RESULT: "result",
+    HISTORY_FORFEIT: "forfeit",
+    HISTORY_TRANSFER: "transfer",
+    HISTORY_ADMIN_SET: "admin_set",
+    HISTORY_ADMIN_RESET: "admin_reset",
+}
+EXPORT_NAME_BATCH = 1000  # 表示名を集めるとき、この人数ごとにイベントループへ処理を返す
+
+def export_ranking_rows(store: PlayerStore, names: dict):
+    yield ("rank", "user_id", "name", "pt", "rank_role")
+    for rank, uid, pt in standard_competition_ranking(store):
+        yield (rank, uid, names.get(uid, ""), pt, get_rank_info(pt)[0])
+
+def export_history_rows(end: int):
+    yield ("time", "kind", "user_a", "user_b", "pt_a", "pt_b")
+    for kind, ts, user_a, user_b, pt_a, pt_b in history_log.iter_records(end):
+        yield (datetime.fromtimestamp(ts, JST).isoformat(), HISTORY_KIND_NAMES.get(kind, str(kind)), user_a, user_b, pt_a, pt_b)
+
+def write_export(path: str, fmt: str, rows) -> int:
+    """
+    rows（先頭はヘッダー）を gzip 圧縮の CSV / JSONL として1行ずつ書き、データ行数を返す（別スレッド用）
+    CSV は Excel でそのまま開けるように BOM 付き UTF-8
+    """
+    count = 0
+    encoding = "utf-8-sig" if fmt == "csv" else "utf-8"
+    with gzip.open(path, "wt", encoding=encoding, newline="", compresslevel=6) as f:
+        header = next(rows)
+        if fmt == "csv":
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                f.write(json.dumps(dict(zip(header, row)), ensure_ascii=False))
+                f.write("\n")
+                count += 1
+    return count
+
+@bot.tree.command(name="admin_export", description="ランキングと対戦・譲渡履歴を圧縮ファイル（CSV / JSONL）で出力")
+@app_commands.describe(fmt="出力形式")
+@app_commands.choices(fmt=[app_commands.Choice(name="CSV", value="csv"), app_commands.Choice(name="JSONL", value="jsonl")])
+async def admin_export(interaction: discord.Interaction, fmt: app_commands.Choice[str]):
+    if interaction.user.id != ADMIN_ID:
+        await interaction.response.send_message("権限がありません。", ephemeral=True)
+        return
+    # 件数が多いと3秒以内に終わらないので先に応答を保留する（followup は15分まで送れる）
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    guild = bot.get_guild(GUILD_ID)
+
+    # ここで取った時点の内容を出力する（以降の変更は別スレッドの読み取りに混ざらない）
+    await history_log.flush()
+    history_end = history_log.size
+    store = player_store.copy()
+    names = {}
+    if guild:
+        for i, uid in enumerate(store):
+            name = ranking_renderer.display_name(guild, uid)
+            if name:
+                names[uid] = name
+            if i % EXPORT_NAME_BATCH == EXPORT_NAME_BATCH - 1:
+                await asyncio.sleep(0)
+
+    stamp = datetime.now(JST).strftime("%Y%m%d_%H%M%S")
+    ext = f"{fmt.value}.gz"
+    workdir = await asyncio.to_thread(tempfile.mkdtemp, prefix="kurisu_export_")
+    try:
+        started = time.perf_counter()
+        ranking_path = os.path.join(workdir, f"ranking_{stamp}.{ext}")
+        history_path = os.path.join(workdir, f"history_{stamp}.{ext}")
+        try:
+            ranking_count = await asyncio.to_thread(write_export, ranking_path, fmt.value, export_ranking_rows(store, names))
+            history_count = await asyncio.to_thread(write_export, history_path, fmt.value, export_history_rows(history_end))
+        except Exception as e:
+            print(f"[ERROR] データ出力に失敗しました: {e}")
+            await interaction.followup.send(f"出力に失敗しました: {e}", ephemeral=True)
+            return
+        elapsed = time.perf_counter() - started
+        limit = guild.filesize_limit if guild else 25 * 1024 * 1024
+        sizes = [os.path.getsize(ranking_path), os.path.getsize(history_path)]
+        if sum(sizes) > limit:
+            await interaction.followup.send(
+                f"出力ファイルが添付できる大きさを超えました（{sum(sizes) / 1024 / 1024:.1f}MB / 上限 {limit / 1024 / 1024:.0f}MB）。",
+                ephemeral=True
+            )
+            return
+        await interaction.followup.send(
+            f"📦 ランキング {ranking_count} 人 / 履歴 {history_count} 件を出力しました（{elapsed*1000:.0f}ms）",
+            files=[discord.File(ranking_path), discord.File(history_path)],
+            ephemeral=True
+        )
+    finally:
+        await asyncio.to_thread(shutil.rmtree, workdir, True)
 
 # /単発イベント /長期イベント /無期限イベント コマンド
 @bot.tree.command(name="単発イベント", description="単発イベント設定")
@@ -642,6 +3528,8 @@ async def cmd_single_event(interaction: discord.Interaction, start: str, end: st
         event_config["active"] = False
     # --------------------------------
 
+    event_scheduler.wake()
+
     await post_event_notice(bot, f"現在のイベント設定🔽\n{start}〜{end}のみマッチング可能です")
     await interaction.response.send_message("単発イベントを設定しました。", ephemeral=True)
 
@@ -688,6 +3576,7 @@ async def cmd_long_event(interaction: discord.Interaction, start_date: str, end_
         await set_matching_channel_permission(bot, False)
         event_config["active"] = False
     # --------------------------------
+    event_scheduler.wake()
 
     await interaction.response.send_message("長期イベントを設定しました。", ephemeral=True)
 
@@ -699,6 +3588,7 @@ async def cmd_unlimited_event(interaction: discord.Interaction):
         return
     event_config.update({"type": "unlimited", "active": True})
     await set_matching_channel_permission(bot, True)
+    event_scheduler.wake()
     await post_event_notice(bot, "現在のイベント設定🔽\nいつでもマッチング可能です")
     await interaction.response.send_message("無期限イベントを設定しました。", ephemeral=True)
 
@@ -712,13 +3602,15 @@ class PtTransferView(ui.View):
         super().__init__(timeout=timeout_seconds)  # デフォルト5分
         self.sender = sender
         self.receiver = receiver
+        self.processed = False
 
     async def on_timeout(self):
         # ボタン未押下でタイムアウト時に呼ばれる
         for child in self.children:
             child.disabled = True  # 全ボタン無効化
         if self.message:  # メッセージが存在する場合のみ編集
-            await self.message.edit(content=f"⏱ {self.sender.mention} → {self.receiver.mention} のPt譲渡提案は期限切れとなりました。", view=self)
+            await rest.call(PRIORITY_INTERACTION, "interaction", lambda: self.message.edit(
+                content=f"⏱ {self.sender.mention} → {self.receiver.mention} のPt譲渡提案は期限切れとなりました。", view=self))
 
     @ui.button(label="承認", style=ButtonStyle.success)
     async def approve(self, interaction: Interaction, button: ui.Button):
@@ -729,28 +3621,38 @@ class PtTransferView(ui.View):
         sender_id = self.sender.id
         receiver_id = self.receiver.id
 
-        sender_pt = user_data.get(sender_id, {}).get("pt", 0)
-        if sender_pt < 1:
-            await interaction.response.send_message("送信者のPtが不足しています。", ephemeral=True)
+        # 残高の確認から反映までを2人分のロックの中で行う（連打・同時の譲渡で二重に引かれないように）
+        error = None
+        async with ledger.transaction(sender_id, receiver_id) as txn:
+            sender_pt = txn.get(sender_id)
+            if self.processed:
+                error = "既に処理済みです。"
+            elif sender_pt < 1:
+                error = "送信者のPtが不足しています。"
+            elif txn.get(receiver_id) >= PT_MAX:
+                error = "受信者のPtが上限に達しています。"
+            else:
+                # Pt送信実行
+                self.processed = True
+                # 送信者を先に書いてから受信者を読む（同じ人なら差し引き 0 になるように）
+                txn.set(sender_id, sender_pt - 1)
+                receiver_pt = txn.get(receiver_id) + 1
+                txn.set(receiver_id, receiver_pt)
+                txn.log(HISTORY_TRANSFER, sender_id, receiver_id, sender_pt - 1, receiver_pt)
+        if error:
+            await interaction.response.send_message(error, ephemeral=True)
             return
 
-        # Pt送信実行
-        user_data[sender_id]["pt"] -= 1
-        user_data.setdefault(receiver_id, {})["pt"] = user_data.get(receiver_id, {}).get("pt", 0) + 1
-
         # ユーザー表示更新
-        w_member = interaction.guild.get_member(sender_id)
-        r_member = interaction.guild.get_member(receiver_id)
-        if w_member:
-            await update_member_display(w_member)
-        if r_member:
-            await update_member_display(r_member)
-
-        # メッセージ更新
+        update_member_display_by_id(interaction.guild, sender_id)
+        update_member_display_by_id(interaction.guild, receiver_id)
+
+        # メッセージ更新（応答は 3 秒制限があるので先に返す）
         for child in self.children:
             child.disabled = True
-        await interaction.message.edit(content=f"✅ {self.sender.mention} → {self.receiver.mention} に1pt譲渡が完了しました！", view=self)
         await interaction.response.send_message("Pt譲渡を承認しました。", ephemeral=True)
+        await rest.call(PRIORITY_INTERACTION, f"channel:{interaction.channel_id}", lambda: interaction.message.edit(
+            content=f"✅ {self.sender.mention} → {self.receiver.mention} に1pt譲渡が完了しました！", view=self))
 
     @ui.button(label="拒否", style=ButtonStyle.danger)
     async def reject(self, interaction: Interaction, button: ui.Button):
@@ -758,10 +3660,15 @@ class PtTransferView(ui.View):
             await interaction.response.send_message("この操作は対象ユーザーのみ行えます。", ephemeral=True)
             return
 
+        if self.processed:
+            await interaction.response.send_message("既に処理済みです。", ephemeral=True)
+            return
+        self.processed = True
         for child in self.children:
             child.disabled = True
-        await interaction.message.edit(content=f"❌ {self.receiver.mention} が譲渡を拒否しました。", view=self)
         await interaction.response.send_message("Pt譲渡を拒否しました。", ephemeral=True)
+        await rest.call(PRIORITY_INTERACTION, f"channel:{interaction.channel_id}", lambda: interaction.message.edit(
+            content=f"❌ {self.receiver.mention} が譲渡を拒否しました。", view=self))
 
 
 # /pt送信 コマンド（JUDGEチャンネル専用）
@@ -772,7 +3679,10 @@ async def pt_send(interaction: discord.Interaction, target_user: discord.User):
         return
 
     sender_id = interaction.user.id
-    if user_data.get(sender_id, {}).get("pt", 0) < 1:
+    if target_user.id == sender_id:
+        await interaction.response.send_message("自分自身には送信できません。", ephemeral=True)
+        return
+    if get_user_pt(sender_id) < 1:
         await interaction.response.send_message("Ptが不足しています。", ephemeral=True)
         return
 
@@ -823,10 +3733,12 @@ async def admin_reset_waiting(interaction: discord.Interaction):
 @bot.event
 async def on_ready():
     print(f"{bot.user} is ready. Guilds: {[g.name for g in bot.guilds]}")
-    await bot.tree.sync()
-    if not hasattr(bot, "event_scheduler_started"):
-        bot.event_scheduler_started = True
-        asyncio.create_task(event_scheduler_loop(bot))
-        print("[INFO] イベントスケジューラーを起動しました")
-
-bot.run(DISCORD_TOKEN)
+    guild = bot.get_guild(GUILD_ID)
+    if guild:
+        if not hasattr(bot, "sessions_restored"):
+            bot.sessions_restored = True
+            restore_sessions(guild, bot.saved_sessions)
+        battle_pool.start(guild)
+
+if __name__ == "__main__":
+    bot.run(DISCORD_TOKEN)